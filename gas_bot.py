@@ -1,42 +1,201 @@
 # -*- coding: utf-8 -*-
 import os
 import asyncio
+import contextlib
+import functools
+import signal
+import threading
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands # Ensure this is imported
 import datetime
 import json
+import hashlib
+import io
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import extensions, pool
 import logging
-from collections import defaultdict # Keep if used elsewhere, maybe not needed now
+from collections import defaultdict, deque
 import time
 import random
+import re
 from typing import Optional # Needed for Optional type hint
 
 # --- Configuration ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
-TARGET_CHANNEL_ID = 1319440273868062861 # Make sure this is correct
+# Optional: fixed shard count for AutoShardedBot (leave unset to let Discord decide)
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+# How often drives/fills are folded into the daily rollups behind /stats
+ROLLUP_REFRESH_MINUTES = int(os.environ.get("ROLLUP_REFRESH_MINUTES", "10"))
+# How often upcoming monthly drive/fill partitions are created and each guild's settled months are archived
+HISTORY_MAINTENANCE_HOURS = float(os.environ.get("HISTORY_MAINTENANCE_HOURS", "24"))
+# Connection pool size (the minimum is opened during startup warm-up and kept open)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# How long a SIGTERM waits for in-flight writes before exiting anyway
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "8"))
+# Opt-in slow-query log: statements (and pool checkouts) taking at least this many ms are logged and
+# their plans kept for /dbprofile. Leave unset to disable profiling entirely.
+DB_SLOW_QUERY_MS = float(os.environ["DB_SLOW_QUERY_MS"]) if os.environ.get("DB_SLOW_QUERY_MS") else None
+DB_PROFILE_BUFFER = int(os.environ.get("DB_PROFILE_BUFFER", "50")) # Slow statements kept in memory
+
+PROCESS_STARTED_AT = time.monotonic() # For time-to-ready / time-to-first-interaction logs
 
 # --- Bot Setup ---
 intents = discord.Intents.default()
 intents.message_content = True # Make sure you need this intent
 intents.members = True
-client = commands.Bot(command_prefix="/", intents=intents) # Use commands.Bot
+
+class GasCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await reject_if_unavailable(interaction)
+
+class GasBot(commands.AutoShardedBot):
+    """Bot with a concurrent cold start (setup_hook) and a graceful SIGTERM drain."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.accepting_interactions = True
+        self.inflight_writes = 0
+        self.writes_idle = None # asyncio.Event, created in setup_hook on the running loop
+        self.warmup_task = None
+        self.sync_task = None
+        self.shutdown_task = None
+        self.db_threads = set() # run_db work still in a worker thread
+        self.first_interaction_logged = False
+
+    async def setup_hook(self):
+        # Runs after login and before the gateway connects. Everything slow is started as a
+        # task here so DB warm-up and command sync overlap the gateway handshake.
+        self.writes_idle = asyncio.Event()
+        self.writes_idle.set()
+        self.warmup_task = asyncio.create_task(asyncio.to_thread(warm_up_database))
+
+        # Route car prompts (including ones sent before a restart) to CarSelect
+        self.add_dynamic_items(CarSelect)
+        register_drive_commands(self.tree)
+        self.sync_task = asyncio.create_task(sync_commands_if_changed(self))
+        refresh_rollups_task.start()
+        history_maintenance_task.start()
+
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, self.request_shutdown
+            )
+        except NotImplementedError: # Windows event loops don't support signal handlers
+            logger.warning("SIGTERM handler not installed; shutdown will not drain in-flight writes.")
+        logger.info(f"setup_hook finished {time.monotonic() - PROCESS_STARTED_AT:.2f}s after start.")
+
+    def request_shutdown(self):
+        """SIGTERM handler: starts graceful_shutdown (keeping a reference so the task isn't collected)."""
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.graceful_shutdown())
+
+    async def run_db(self, func, *args):
+        """Runs func(conn, *args) with a pooled connection in a worker thread.
+
+        The thread can't be cancelled, so the work is shielded and tracked: close() waits for it
+        before closing the pool even if the awaiting task was cancelled.
+        """
+        task = asyncio.ensure_future(asyncio.to_thread(run_with_connection, func, *args))
+        self.db_threads.add(task)
+        task.add_done_callback(self.db_threads.discard)
+        return await asyncio.shield(task)
+
+    async def wait_until_warm(self):
+        """Waits for the startup DB warm-up (pool + guild configs) if it is still running."""
+        if self.warmup_task and not self.warmup_task.done():
+            await asyncio.wait({self.warmup_task})
+
+    @contextlib.asynccontextmanager
+    async def track_write(self):
+        """Marks a DB write (and the board update that follows it) as in flight for shutdown draining."""
+        self.inflight_writes += 1
+        if self.writes_idle:
+            self.writes_idle.clear()
+        try:
+            yield
+        finally:
+            self.inflight_writes -= 1
+            if self.inflight_writes == 0 and self.writes_idle:
+                self.writes_idle.set()
+
+    async def graceful_shutdown(self):
+        """Stops taking interactions, drains in-flight writes/board updates, then closes the bot."""
+        if not self.accepting_interactions:
+            return
+        self.accepting_interactions = False
+        logger.info(f"SIGTERM received: draining {self.inflight_writes} in-flight write(s)...")
+
+        try:
+            await asyncio.wait_for(self.writes_idle.wait(), timeout=SHUTDOWN_DRAIN_SECONDS)
+            logger.info("In-flight writes drained.")
+        except asyncio.TimeoutError:
+            logger.warning(f"Gave up draining after {SHUTDOWN_DRAIN_SECONDS}s with {self.inflight_writes} write(s) still running.")
+        await self.close()
+
+    async def close(self):
+        # Stop the background loops, then wait for them and for DB work still in worker threads
+        # (warm-up, rollup refresh, maintenance, /export) so no connection is closed mid-statement.
+        for loop in (refresh_rollups_task, history_maintenance_task):
+            loop.cancel()
+        pending = {task for task in (refresh_rollups_task.get_task(), history_maintenance_task.get_task(),
+                                     self.warmup_task, self.sync_task) if task and task is not asyncio.current_task()}
+        pending |= self.db_threads
+        if pending:
+            _, still_running = await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_SECONDS)
+            if still_running:
+                logger.warning(f"Closing with {len(still_running)} background task(s) still running.")
+        await super().close()
+        # Only idle connections are closed; ones still checked out are closed when they are released
+        close_db_pool()
+
+# AutoShardedBot runs a single shard for small deployments and scales out for many guilds.
+# Member chunking is skipped at startup; slash command options resolve members on demand.
+client = GasBot(
+    command_prefix="/", intents=intents, shard_count=SHARD_COUNT, chunk_guilds_at_startup=False,
+    tree_cls=GasCommandTree
+)
+
+async def reject_if_unavailable(interaction: discord.Interaction) -> bool:
+    """Interaction check shared by slash commands and components during warm-up and shutdown.
+
+    Answers right away instead of waiting: Discord fails interactions that aren't acknowledged
+    within 3 seconds, and handlers run their DB calls on the event loop, so they must not race
+    the warm-up thread for the pool.
+    """
+    warming_up = client.warmup_task is not None and not client.warmup_task.done()
+    if client.accepting_interactions and not warming_up:
+        return True
+    if interaction.type is discord.InteractionType.autocomplete:
+        return False # Autocomplete can't show a message
+    if warming_up:
+        await interaction.response.send_message("⏳ The bot is still starting up, please try again in a few seconds.", ephemeral=True)
+    else:
+        await interaction.response.send_message("⏳ The bot is restarting, please try again in a moment.", ephemeral=True)
+    return False
+
+def tracks_write(func):
+    """Decorator: runs a coroutine inside client.track_write()."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with client.track_write():
+            return await func(*args, **kwargs)
+    return wrapper
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO) # Set to INFO for less verbose logs, DEBUG for more
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG) # Uncomment for detailed debugging
 
-# --- Car Data (Simplified) ---
+# --- Default Car Data (seeded into each new guild's config) ---
 CARS = [
-    {"name": "Subaru/Jaguar/Z3", "mpg": 20},
-    {"name": "Mercedes", "mpg": 17},
+    {"name": "Subaru/Jaguar/Z3", "mpg": 20, "tank_gallons": 16},
+    {"name": "Mercedes", "mpg": 17, "tank_gallons": 18},
 ]
 
-# --- Location Shortcut Configuration ---
+# --- Default Location Shortcuts (seeded into each new guild's config) ---
+# Each key is also registered as a global slash command; it resolves against the guild's own locations.
 LOCATION_COMMANDS = {
     "pnc": {"miles": 2.0, "location": "PNC"},
     "lifetime": {"miles": 14.4, "location": "Life Time"},
@@ -66,6 +225,22 @@ LOCATION_COMMANDS = {
     "btt": {"miles": 11, "location": "Brazilian Top Team"},
 }
 
+# Location keys end up in slash command names and component custom_ids
+LOCATION_KEY_PATTERN = re.compile(r"^[a-z0-9]{1,32}$")
+
+# --- Fill Cost Allocation Modes ---
+# "equal": every user in the guild pays the same share of a fill.
+# "usage": users pay in proportion to their miles in that car since its previous fill.
+FILL_ALLOCATION_MODES = {
+    "equal": "split equally between everyone",
+    "usage": "split by miles driven in that car since its last fill",
+}
+
+# --- Per-Guild Config Cache ---
+# guild_id -> {"target_channel_id", "fill_allocation", "low_fuel_percent", "low_fuel_nudge", "nicknames", "cars", "locations"};
+# filled lazily or in bulk on ready.
+GUILD_CONFIG_CACHE = {}
+
 # --- Helper Functions ---
 def calculate_cost(distance, mpg, price_per_gallon):
     """Calculates cost based on distance, mpg, and gas price."""
@@ -76,23 +251,29 @@ def calculate_cost(distance, mpg, price_per_gallon):
     cost = gallons_used * price_per_gallon
     return round(cost, 2)
 
-def format_balance_message(users_with_miles, interaction):
+def display_name_for(guild_config, user_id, fallback_name):
+    """Returns the guild's nickname for a user, falling back to their stored/display name."""
+    return guild_config["nicknames"].get(str(user_id), fallback_name)
+
+def format_balance_message(users_with_miles, guild_config):
     """Formats the balance message (Car notes section is removed)."""
     message = ""
-    nickname_mapping = {
-        "858864178962235393": "Abbas", "513552727096164378": "Sajjad",
-        "758778170421018674": "Jafar", "838206242127085629": "Mosa",
-        "393241098002235392": "Ali",
-    }
+    nicknames = guild_config["nicknames"]
+
+    # Nicknamed users first (in configured order), then everyone else by name
+    ordered_ids = [user_id for user_id in nicknames if user_id in users_with_miles]
+    ordered_ids += sorted(
+        (user_id for user_id in users_with_miles if user_id not in nicknames),
+        key=lambda user_id: users_with_miles[user_id].get("name", "").lower()
+    )
 
     message += "```\n--- Balances ---\n"
     found_users = False
-    for user_id in nickname_mapping:
-        if user_id in users_with_miles:
-            user_data = users_with_miles[user_id]
-            nickname = nickname_mapping.get(user_id, user_data.get("name", f"User {user_id}"))
-            message += f"{nickname}: ${user_data.get('total_owed', 0.0):.2f}\n"
-            found_users = True
+    for user_id in ordered_ids:
+        user_data = users_with_miles[user_id]
+        nickname = display_name_for(guild_config, user_id, user_data.get("name", f"User {user_id}"))
+        message += f"{nickname}: ${user_data.get('total_owed', 0.0):.2f}\n"
+        found_users = True
 
     if not found_users:
         message += "No user balances found.\n"
@@ -100,119 +281,514 @@ def format_balance_message(users_with_miles, interaction):
     message += "```\n"
     return message
 
+def find_car(guild_config, car_id):
+    """Looks up a car in the guild's cached car list by ID."""
+    return next((car for car in guild_config["cars"] if car["id"] == car_id), None)
+
 # --- format_car_usage_message REMOVED ---
 
 # --- Database Functions ---
+# --- Slow-Query Profiling (opt-in with DB_SLOW_QUERY_MS) ---
+# Statements at or over the threshold are logged with their parameters redacted and kept, with their
+# plans, in a bounded in-memory ring buffer for /dbprofile. Plans come from the server's auto_explain
+# module, loaded on each profiled connection: it explains the statements as they actually run
+# (including the ones inside record_fill_func and the other plpgsql functions/procedures) and sends
+# the plans back as NOTICEs, so nothing is executed twice.
+SLOW_QUERIES = deque(maxlen=DB_PROFILE_BUFFER)
+slow_queries_lock = threading.Lock()
+PLAN_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+QUERY_TEXT_NUMBER_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLAN_CONDITION_PREFIXES = ("Filter:", "Index Cond:", "Recheck Cond:", "Join Filter:", "Hash Cond:", "Merge Cond:", "One-Time Filter:")
+
+def normalize_statement(query):
+    """Collapses whitespace so the same statement groups together in /dbprofile."""
+    return " ".join(query.split())
+
+def redact_params(params):
+    """Describes query parameters by type only (e.g. "(int, str, NoneType)") so no values reach the logs."""
+    if params is None:
+        return "()"
+    values = params.values() if isinstance(params, dict) else params
+    return "(" + ", ".join(type(value).__name__ for value in values) + ")"
+
+def redact_plan(plan):
+    """Masks literals in an auto_explain plan. Query text has the bound values inlined (psycopg2
+    binds client-side), so numbers are masked on every line of it, up to the first plan node, and on
+    the plan's condition lines, which repeat those values."""
+    lines = []
+    in_query_text = False
+    for line in PLAN_LITERAL_PATTERN.sub("'…'", plan).splitlines():
+        if line.lstrip().startswith("Query Text:"):
+            in_query_text = True
+        elif "(cost=" in line or "duration:" in line:
+            in_query_text = False
+        if in_query_text or line.lstrip().startswith(PLAN_CONDITION_PREFIXES):
+            line = QUERY_TEXT_NUMBER_PATTERN.sub("?", line)
+        lines.append(line)
+    return "\n".join(lines)
+
+def record_slow_query(statement, params, duration_ms, plan=None):
+    logger.warning(f"Slow DB statement ({duration_ms:.0f} ms, params {redact_params(params)}): {statement[:300]}")
+    with slow_queries_lock:
+        SLOW_QUERIES.append({
+            "statement": statement,
+            "duration_ms": duration_ms,
+            "plan": plan,
+            "at": datetime.datetime.now(datetime.timezone.utc),
+        })
+
+class ProfilingConnection(extensions.connection):
+    """Connection that turns on auto_explain for itself and hands out ProfilingCursors."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = ProfilingCursor
+        self.notices = deque(maxlen=100) # auto_explain plans arrive here
+        cur = super().cursor(cursor_factory=extensions.cursor)
+        try:
+            cur.execute("LOAD 'auto_explain'")
+            cur.execute("SET auto_explain.log_min_duration = %s", (int(DB_SLOW_QUERY_MS),))
+            cur.execute("SET auto_explain.log_analyze = on")
+            cur.execute("SET auto_explain.log_buffers = on")
+            cur.execute("SET auto_explain.log_nested_statements = on")
+            cur.execute("SET auto_explain.log_level = notice") # Deliver plans to this client, not just the server log
+            self.commit()
+        except psycopg2.Error as e:
+            # Loading auto_explain needs superuser unless the server preloads it or has it in $libdir/plugins
+            self.rollback()
+            logger.warning(f"auto_explain unavailable; slow statements will be logged without plans: {e}")
+        finally:
+            cur.close()
+
+class ProfilingCursor(extensions.cursor):
+    """Cursor that times execute() and records statements over DB_SLOW_QUERY_MS with their auto_explain plans."""
+    def execute(self, query, vars=None):
+        self.connection.notices.clear()
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= DB_SLOW_QUERY_MS:
+            if not isinstance(query, str):
+                query = query.decode() if isinstance(query, bytes) else query.as_string(self.connection)
+            # One notice per slow statement, nested ones first, then the top-level statement (if explainable)
+            plans = [notice.strip() for notice in self.connection.notices if "plan:" in notice]
+            plan = redact_plan("\n\n".join(plans)) if plans else None
+            record_slow_query(normalize_statement(query), vars, duration_ms, plan)
+        return result
+
+def get_slow_query_summary(limit=5):
+    """Groups the captured slow statements. Returns (rows, slowest) where rows are
+    {"statement", "count", "max_ms", "avg_ms"} by total time, and slowest is the worst capture with a plan."""
+    with slow_queries_lock:
+        captured = list(SLOW_QUERIES)
+    grouped = {}
+    for entry in captured:
+        group = grouped.setdefault(entry["statement"], {"statement": entry["statement"], "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        group["count"] += 1
+        group["total_ms"] += entry["duration_ms"]
+        group["max_ms"] = max(group["max_ms"], entry["duration_ms"])
+    rows = sorted(grouped.values(), key=lambda group: -group["total_ms"])[:limit]
+    for group in rows:
+        group["avg_ms"] = group["total_ms"] / group["count"]
+    slowest = max((entry for entry in captured if entry["plan"]), key=lambda entry: entry["duration_ms"], default=None)
+    return rows, slowest
+
+db_pool = None
+db_pool_lock = threading.Lock()
+# TCP keepalives let the OS notice dead peers; a ping on checkout catches connections the server closed while idle
+DB_KEEPALIVES = {"keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3}
+DB_PING_AFTER_IDLE_SECONDS = 60
+DB_CONNECT_TIMEOUT_SECONDS = 5 # Fail fast instead of hanging warm-up or a handler on an unreachable server
+pooled_since = {} # id(conn) -> time.monotonic() when it was returned to the pool
+
+def init_db_pool():
+    """Creates the shared connection pool (opening DB_POOL_MIN connections) if needed."""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            profiling = {"connection_factory": ProfilingConnection} if DB_SLOW_QUERY_MS is not None else {}
+            db_pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, sslmode='require', connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                **DB_KEEPALIVES, **profiling
+            )
+    return db_pool
+
+def close_db_pool():
+    """Closes the pool's idle connections. Connections still checked out are closed by release_db_connection
+    (closeall() would close those too, under whatever is still using them)."""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            for conn in list(db_pool._pool): # Idle connections (psycopg2 keeps no public accessor)
+                conn.close()
+            db_pool = None
+            pooled_since.clear()
+
+def connection_is_alive(conn):
+    """Pings a pooled connection, leaving it idle (no open transaction)."""
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT 1")
+        finally:
+            cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
+    """Borrows a connection from the pool; give it back with release_db_connection."""
+    started = time.perf_counter()
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+        conn = init_db_pool().getconn()
+        idle_since = pooled_since.pop(id(conn), None)
+        idle_too_long = idle_since is not None and time.monotonic() - idle_since > DB_PING_AFTER_IDLE_SECONDS
+        if conn.closed or (idle_too_long and not connection_is_alive(conn)): # Dropped since it was pooled
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        if DB_SLOW_QUERY_MS is not None:
+            duration_ms = (time.perf_counter() - started) * 1000
+            if duration_ms >= DB_SLOW_QUERY_MS: # Pool creation or a fresh connection (TLS handshake)
+                record_slow_query("(connection checkout)", None, duration_ms)
         return conn
-    except psycopg2.OperationalError as e:
+    except (psycopg2.OperationalError, pool.PoolError) as e:
         logger.error(f"Failed to connect to database: {e}")
         raise # Re-raise the exception so calling code knows connection failed
 
-def initialize_cars_in_db(conn):
-    """Ensures only the desired cars exist in the DB."""
-    # Keep this function as is from previous version
-    cur = conn.cursor()
-    desired_cars = {car["name"]: car["mpg"] for car in CARS}
-    car_names_tuple = tuple(desired_cars.keys())
+def release_db_connection(conn):
+    """Returns a borrowed connection to the pool (rolling back anything uncommitted)."""
+    if conn is None:
+        return
+    if db_pool is None: # Pool closed while this connection was checked out
+        if not conn.closed:
+            conn.close()
+        return
+    if not conn.closed:
+        pooled_since[id(conn)] = time.monotonic()
+    db_pool.putconn(conn, close=bool(conn.closed))
 
+def run_with_connection(func, *args):
+    """Calls func(conn, *args) with a pooled connection (for use in a worker thread, see GasBot.run_db)."""
+    conn = get_db_connection()
     try:
-        # Delete cars not in the desired list
-        if len(car_names_tuple) == 1:
-            delete_sql = "DELETE FROM cars WHERE name != %s"
-            cur.execute(delete_sql, (car_names_tuple[0],))
-        elif len(car_names_tuple) > 1:
-            delete_sql = sql.SQL("DELETE FROM cars WHERE name NOT IN {}").format(sql.Literal(car_names_tuple))
-            cur.execute(delete_sql)
-        else:
-            cur.execute("DELETE FROM cars")
-        logger.info(f"Deleted cars not in {list(desired_cars.keys())}. Rows affected: {cur.rowcount}")
+        return func(conn, *args)
+    finally:
+        release_db_connection(conn)
+
+def warm_up_database():
+    """Startup warm-up (runs in a worker thread): opens the pool and loads every known guild config."""
+    started = time.monotonic()
+    init_db_pool()
+    conn = get_db_connection()
+    try:
+        ensure_monthly_partitions(conn)
+        loaded = load_all_guild_configs(conn)
+    finally:
+        release_db_connection(conn)
+    logger.info(f"DB warm-up done in {time.monotonic() - started:.2f}s ({loaded} guild config(s) cached).")
 
-        # Insert or update desired cars
-        for name, mpg in desired_cars.items():
+def seed_guild_defaults(conn, guild_id):
+    """Creates the config row for a new guild and seeds the default cars and locations."""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO guild_configs (guild_id) VALUES (%s) ON CONFLICT (guild_id) DO NOTHING",
+            (guild_id,)
+        )
+        if cur.rowcount == 0:
+            return # Another process already seeded this guild
+        for car in CARS:
             cur.execute(
                 """
-                INSERT INTO cars (name, mpg) VALUES (%s, %s)
-                ON CONFLICT (name) DO UPDATE SET mpg = EXCLUDED.mpg;
+                INSERT INTO cars (guild_id, name, mpg, tank_gallons) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (guild_id, name) DO NOTHING;
                 """,
-                (name, mpg)
+                (guild_id, car["name"], car["mpg"], car["tank_gallons"])
+            )
+        for key, data in LOCATION_COMMANDS.items():
+            cur.execute(
+                """
+                INSERT INTO guild_locations (guild_id, command, location, miles) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (guild_id, command) DO NOTHING;
+                """,
+                (guild_id, key, data["location"], data["miles"])
             )
-            # logger.info(f"Ensured car '{name}' exists with MPG {mpg}") # Reduce log verbosity
         conn.commit()
-        logger.info("Car initialization in DB complete.")
+        logger.info(f"Seeded default config for guild {guild_id}.")
     except psycopg2.Error as e:
-        logger.error(f"Database error during car initialization: {e}")
-        conn.rollback() # Rollback on error
+        logger.error(f"Database error seeding guild {guild_id}: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def load_guild_configs(conn, guild_ids):
+    """Bulk-loads configs for the given guilds into GUILD_CONFIG_CACHE (one query per table)."""
+    guild_ids = [int(guild_id) for guild_id in guild_ids]
+    if not guild_ids:
+        return {}
+    configs = {
+        guild_id: {
+            "target_channel_id": None, "fill_allocation": "equal", "low_fuel_percent": 15, "low_fuel_nudge": False,
+            "nicknames": {}, "cars": [], "locations": {}
+        }
+        for guild_id in guild_ids
+    }
+    found = set()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT guild_id, target_channel_id, fill_allocation, low_fuel_percent, low_fuel_nudge
+            FROM guild_configs WHERE guild_id = ANY(%s)
+            """,
+            (guild_ids,)
+        )
+        for guild_id, target_channel_id, fill_allocation, low_fuel_percent, low_fuel_nudge in cur.fetchall():
+            configs[guild_id]["target_channel_id"] = target_channel_id
+            configs[guild_id]["fill_allocation"] = fill_allocation
+            configs[guild_id]["low_fuel_percent"] = low_fuel_percent
+            configs[guild_id]["low_fuel_nudge"] = low_fuel_nudge
+            found.add(guild_id)
+        cur.execute(
+            "SELECT guild_id, user_id, nickname FROM guild_nicknames WHERE guild_id = ANY(%s) ORDER BY guild_id, position, user_id",
+            (guild_ids,)
+        )
+        for guild_id, user_id, nickname in cur.fetchall():
+            configs[guild_id]["nicknames"][str(user_id)] = nickname
+        cur.execute("SELECT guild_id, id, name, mpg, tank_gallons FROM cars WHERE guild_id = ANY(%s) ORDER BY guild_id, id", (guild_ids,))
+        for guild_id, car_id, name, mpg, tank_gallons in cur.fetchall():
+            configs[guild_id]["cars"].append({"id": car_id, "name": name, "mpg": mpg, "tank_gallons": float(tank_gallons)})
+        cur.execute(
+            "SELECT guild_id, command, location, miles FROM guild_locations WHERE guild_id = ANY(%s) ORDER BY guild_id, command",
+            (guild_ids,)
+        )
+        for guild_id, command, location, miles in cur.fetchall():
+            configs[guild_id]["locations"][command] = {"miles": float(miles), "location": location}
+    finally:
+        cur.close()
+
+    # Guilds seen for the first time get the defaults, then are re-read
+    missing = [guild_id for guild_id in guild_ids if guild_id not in found]
+    for guild_id in missing:
+        seed_guild_defaults(conn, guild_id)
+    if missing:
+        configs.update(load_guild_configs(conn, missing))
+
+    GUILD_CONFIG_CACHE.update(configs)
+    return configs
+
+def load_all_guild_configs(conn):
+    """Caches the config of every guild in the database (used by the startup warm-up)."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT guild_id FROM guild_configs")
+        guild_ids = [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+    return len(load_guild_configs(conn, guild_ids))
+
+def get_guild_config(conn, guild_id):
+    """Returns the cached config for a guild, loading (and seeding) it on a cache miss."""
+    guild_id = int(guild_id)
+    config = GUILD_CONFIG_CACHE.get(guild_id)
+    if config is None:
+        config = load_guild_configs(conn, [guild_id])[guild_id]
+    return config
+
+def get_cached_guild_config(guild_id):
+    """Like get_guild_config, but only opens a DB connection on a cache miss."""
+    config = GUILD_CONFIG_CACHE.get(int(guild_id))
+    if config is not None:
+        return config
+    conn = get_db_connection()
+    try:
+        return get_guild_config(conn, guild_id)
+    finally:
+        release_db_connection(conn)
+
+def invalidate_guild_config(guild_id):
+    GUILD_CONFIG_CACHE.pop(int(guild_id), None)
+
+def set_guild_target_channel(conn, guild_id, channel_id):
+    cur = conn.cursor()
+    try:
+        cur.execute("UPDATE guild_configs SET target_channel_id = %s WHERE guild_id = %s", (channel_id, guild_id))
+        conn.commit()
+    finally:
+        cur.close()
+    invalidate_guild_config(guild_id)
+
+def set_guild_fill_allocation(conn, guild_id, mode):
+    if mode not in FILL_ALLOCATION_MODES:
+        raise ValueError(f"Unknown fill allocation mode '{mode}'.")
+    cur = conn.cursor()
+    try:
+        cur.execute("UPDATE guild_configs SET fill_allocation = %s WHERE guild_id = %s", (mode, guild_id))
+        conn.commit()
+    finally:
+        cur.close()
+    invalidate_guild_config(guild_id)
+
+def set_guild_low_fuel(conn, guild_id, percent, nudge):
+    """Sets the near-empty threshold (% of the tank) and whether crossing it posts a reminder."""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "UPDATE guild_configs SET low_fuel_percent = %s, low_fuel_nudge = %s WHERE guild_id = %s",
+            (percent, nudge, guild_id)
+        )
+        # Re-flag the guild's cars against the new threshold in the same transaction
+        cur.execute(
+            """
+            UPDATE car_state s SET near_empty = s.gallons_left <= c.tank_gallons * %s / 100.0, updated_at = now()
+            FROM cars c
+            WHERE c.id = s.car_id AND s.guild_id = %s
+            """,
+            (percent, guild_id)
+        )
+        conn.commit()
     finally:
         cur.close()
+    invalidate_guild_config(guild_id)
 
-def get_car_id_from_name(conn, car_name):
-    # Keep this function as is
+def set_guild_nickname(conn, guild_id, user_id, nickname):
+    """Sets (or clears, when nickname is None) a user's display nickname in a guild."""
     cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM cars WHERE name = %s", (car_name,))
-        result = cur.fetchone()
-        if result:
-            return result[0]
+        if nickname:
+            cur.execute(
+                """
+                INSERT INTO guild_nicknames (guild_id, user_id, nickname, position)
+                VALUES (%s, %s, %s, (SELECT COALESCE(MAX(position), 0) + 1 FROM guild_nicknames WHERE guild_id = %s))
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET nickname = EXCLUDED.nickname;
+                """,
+                (guild_id, user_id, nickname, guild_id)
+            )
         else:
-            logger.error(f"Could not find car_id for car name: {car_name}")
-            raise ValueError(f"Car named '{car_name}' not found in the database.")
+            cur.execute("DELETE FROM guild_nicknames WHERE guild_id = %s AND user_id = %s", (guild_id, user_id))
+        conn.commit()
     finally:
         cur.close()
+    invalidate_guild_config(guild_id)
 
-def get_car_name_from_id(conn, car_id):
-    # Keep this function as is
-    if conn is None or conn.closed:
-        logger.error("get_car_name_from_id: Database connection is closed or invalid.")
-        return "Unknown Car"
+def upsert_guild_car(conn, guild_id, name, mpg, tank_gallons=None):
+    """Adds a car or updates its MPG (and tank size, when given)."""
     cur = conn.cursor()
     try:
-        cur.execute("SELECT name FROM cars WHERE id = %s", (car_id,))
-        result = cur.fetchone()
-        return result[0] if result else None
-    except Exception as e:
-        logger.error(f"Error fetching car name for ID {car_id}: {e}")
-        return "Error Fetching Name"
+        cur.execute(
+            """
+            INSERT INTO cars (guild_id, name, mpg, tank_gallons) VALUES (%s, %s, %s, COALESCE(%s, 15))
+            ON CONFLICT (guild_id, name) DO UPDATE
+            SET mpg = EXCLUDED.mpg, tank_gallons = COALESCE(%s, cars.tank_gallons);
+            """,
+            (guild_id, name, mpg, tank_gallons, tank_gallons)
+        )
+        # Re-estimate the car's fuel from its miles since the last fill with the new MPG/tank size
+        cur.execute(
+            """
+            UPDATE car_state s
+            SET gallons_left = GREATEST(c.tank_gallons - s.miles_since_fill / NULLIF(c.mpg, 0), 0),
+                near_empty = GREATEST(c.tank_gallons - s.miles_since_fill / NULLIF(c.mpg, 0), 0)
+                             <= c.tank_gallons * COALESCE(g.low_fuel_percent, 15) / 100.0,
+                updated_at = now()
+            FROM cars c LEFT JOIN guild_configs g ON g.guild_id = c.guild_id
+            WHERE c.guild_id = %s AND c.name = %s AND s.car_id = c.id
+            """,
+            (guild_id, name)
+        )
+        conn.commit()
+    finally:
+        cur.close()
+    invalidate_guild_config(guild_id)
+
+def upsert_guild_location(conn, guild_id, command, location, miles):
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO guild_locations (guild_id, command, location, miles) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (guild_id, command) DO UPDATE SET location = EXCLUDED.location, miles = EXCLUDED.miles;
+            """,
+            (guild_id, command, location, miles)
+        )
+        conn.commit()
+    finally:
+        cur.close()
+    invalidate_guild_config(guild_id)
+
+def delete_guild_location(conn, guild_id, command):
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM guild_locations WHERE guild_id = %s AND command = %s", (guild_id, command))
+        deleted = cur.rowcount > 0
+        conn.commit()
+    finally:
+        cur.close()
+    invalidate_guild_config(guild_id)
+    return deleted
+
+def get_bot_state(conn, key):
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT value FROM bot_state WHERE key = %s", (key,))
+        row = cur.fetchone()
+        return row[0] if row else None
     finally:
-        if cur: cur.close()
+        cur.close()
+
+def set_bot_state(conn, key, value):
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO bot_state (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+            (key, value)
+        )
+        conn.commit()
+    finally:
+        cur.close()
 
-def get_or_create_user(conn, user_id, user_name):
-    # Keep this function as is
+def get_or_create_user(conn, guild_id, user_id, user_name):
     cur = conn.cursor()
     try:
-        cur.execute("SELECT name, total_owed FROM users WHERE id = %s", (user_id,))
+        cur.execute("SELECT name, total_owed FROM users WHERE guild_id = %s AND id = %s", (guild_id, user_id))
         user = cur.fetchone()
         if user is None:
-            cur.execute("INSERT INTO users (id, name, total_owed) VALUES (%s, %s, %s)", (user_id, user_name, 0))
+            cur.execute(
+                "INSERT INTO users (guild_id, id, name, total_owed) VALUES (%s, %s, %s, %s)",
+                (guild_id, user_id, user_name, 0)
+            )
             conn.commit()
-            logger.info(f"Created new user: {user_name} ({user_id})")
+            logger.info(f"Created new user: {user_name} ({user_id}) in guild {guild_id}")
             return {"name": user_name, "total_owed": 0.0}
         else:
             return {"name": user[0], "total_owed": float(user[1]) if user[1] is not None else 0.0}
     finally:
         cur.close()
 
-def save_user_data(conn, user_id, user_name, total_owed):
-    # Keep this function as is
+def settle_guild_balances(conn, guild_id):
+    """Resets every user's balance in one guild to zero. Returns the number of users reset."""
     cur = conn.cursor()
     try:
-        cur.execute("UPDATE users SET name=%s, total_owed=%s WHERE id=%s", (user_name, total_owed, user_id))
+        cur.execute("UPDATE users SET total_owed = 0 WHERE guild_id = %s", (guild_id,))
+        settled = cur.rowcount
+        # Months that ended before this settle become eligible for archiving
+        cur.execute("UPDATE guild_configs SET last_settled_at = now() WHERE guild_id = %s", (guild_id,))
         conn.commit()
+        return settled
     finally:
         cur.close()
 
-def get_all_users_with_miles(conn):
-    # Keep this function as is
+def get_all_users_with_miles(conn, guild_id):
+    """Returns {str(user_id): {...}} for every user in the guild."""
     cur = conn.cursor()
     users_data = {}
     try:
-        cur.execute("SELECT * FROM get_all_users_with_miles_and_car_usage_func()")
+        cur.execute("SELECT * FROM get_all_users_with_miles_and_car_usage_func(%s)", (guild_id,))
         fetched_rows = cur.fetchall()
         for row in fetched_rows:
             if len(row) >= 5:
-                users_data[row[0]] = {
+                users_data[str(row[0])] = {
                     "name": row[1],
                     "total_owed": float(row[2]) if row[2] is not None else 0.0,
                     "total_miles": float(row[3]) if row[3] is not None else 0.0,
@@ -225,21 +801,24 @@ def get_all_users_with_miles(conn):
     return users_data
 
 # --- add_payment (Keep as is) ---
-def add_payment(conn, payer_id, payer_name, amount):
+def add_payment(conn, guild_id, payer_id, payer_name, amount):
     cur = conn.cursor()
     timestamp_iso = datetime.datetime.now().isoformat()
     try:
-        cur.execute("INSERT INTO payments (timestamp, payer_id, payer_name, amount) VALUES (%s, %s, %s, %s)", (timestamp_iso, payer_id, payer_name, amount))
+        cur.execute(
+            "INSERT INTO payments (guild_id, timestamp, payer_id, payer_name, amount) VALUES (%s, %s, %s, %s, %s)",
+            (guild_id, timestamp_iso, payer_id, payer_name, amount)
+        )
         conn.commit()
     finally:
         cur.close()
 
 # --- Gas Price Functions (Keep as is) ---
-def get_current_gas_price(conn):
+def get_current_gas_price(conn, guild_id):
     cur = conn.cursor()
     price_val = 3.30 # Default
     try:
-        cur.execute("SELECT price FROM gas_prices ORDER BY id DESC LIMIT 1")
+        cur.execute("SELECT price FROM gas_prices WHERE guild_id = %s ORDER BY id DESC LIMIT 1", (guild_id,))
         price = cur.fetchone()
         if price and price[0] is not None:
             try:
@@ -247,25 +826,29 @@ def get_current_gas_price(conn):
             except (ValueError, TypeError):
                 logger.error(f"Invalid gas price found in DB: {price[0]}. Falling back to default.")
         else:
-            logger.warning("No gas price found in DB, using default: 3.30")
+            logger.warning(f"No gas price found in DB for guild {guild_id}, using default: 3.30")
     finally:
         cur.close()
     return price_val
 
-# --- record_drive (Keep as is - including location parameter) ---
-def record_drive(conn, user_id, user_name, car_id, distance, cost, near_empty, timestamp_iso, location=None):
+# --- record_drive (including location parameter) ---
+def record_drive(conn, guild_id, user_id, user_name, car_id, distance, cost, timestamp_iso, location=None):
+    """Records a drive. Returns the car's fuel state after it: {"gallons_left", "became_near_empty"}."""
     cur = conn.cursor()
     try:
-        # Assuming your SQL function record_drive_func takes 7 arguments
-        # If it takes 8 (including location), modify the call
-        cur.execute("CALL record_drive_func(%s, %s, %s, %s, %s, %s, %s)",
-                    (user_id, user_name, car_id, distance, cost, near_empty, timestamp_iso))
+        cur.execute("CALL record_drive_func(%s, %s, %s, %s, %s, %s, %s, NULL, NULL)",
+                    (guild_id, user_id, user_name, car_id, distance, cost, timestamp_iso))
+        gallons_left, became_near_empty = cur.fetchone()
         # If you need to store location and the function doesn't, you'd need an UPDATE here,
         # but that requires getting the ID of the inserted drive.
         if location:
              logger.info(f"Drive location '{location}' provided but might not be stored by record_drive_func.")
         conn.commit()
-        logger.info(f"Drive recorded via func: User {user_id}, CarID {car_id}, Dist {distance}, Cost {cost}, Loc {location}")
+        logger.info(f"Drive recorded via func: Guild {guild_id}, User {user_id}, CarID {car_id}, Dist {distance}, Cost {cost}, Loc {location}")
+        return {
+            "gallons_left": float(gallons_left) if gallons_left is not None else None,
+            "became_near_empty": bool(became_near_empty),
+        }
     except Exception as e:
         conn.rollback()
         logger.error(f"Error calling record_drive_func: {e}", exc_info=True)
@@ -273,230 +856,405 @@ def record_drive(conn, user_id, user_name, car_id, distance, cost, near_empty, t
     finally:
         cur.close()
 
-# --- get_car_data REMOVED ---
+# --- Usage Rollups (served to /stats; never read the raw drives table at request time) ---
+def refresh_daily_rollups(conn):
+    """Folds the drives/fills queued since the last refresh (rollup_queue) into the daily rollup table."""
+    cur = conn.cursor()
+    try:
+        cur.execute("CALL refresh_daily_rollups_func()")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
 
-# --- Bot UI Elements ---
+def get_daily_rollups(conn, guild_id, since_day):
+    """Returns (day, user_id, car_id, miles, drive_cost, drive_count, fill_share, fill_paid) rows for a guild."""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT day, user_id, car_id, miles, drive_cost, drive_count, fill_share, fill_paid
+            FROM user_car_daily
+            WHERE guild_id = %s AND day >= %s
+            """,
+            (guild_id, since_day)
+        )
+        return cur.fetchall()
+    finally:
+        cur.close()
 
-class CarDropdown(discord.ui.Select):
-    """Dropdown for selecting a car during drive logging."""
-    def __init__(self, distance: float, location_name: str = None):
-        self.distance = distance
-        self.location_name = location_name
-        options = [
-            discord.SelectOption(label=car["name"], description=f"{car['mpg']} MPG")
-            for car in CARS
-        ]
-        super().__init__(placeholder="Choose the car...", options=options, min_values=1, max_values=1)
+def get_user_names(conn, guild_id):
+    """Returns {str(user_id): stored name} for every user in the guild."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT id, name FROM users WHERE guild_id = %s", (guild_id,))
+        return {str(user_id): name for user_id, name in cur.fetchall()}
+    finally:
+        cur.close()
 
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(ephemeral=True, thinking=True)
+# --- History Partitions & Archive (live tables stay small; /history and /export read both) ---
+def ensure_monthly_partitions(conn):
+    """Creates any missing drives/fills partitions up to two months ahead. Returns the number created."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT ensure_monthly_partitions_func()")
+        created = cur.fetchone()[0]
+        conn.commit()
+        return created
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
 
-        selected_car_name = self.values[0]
-        user_id = str(interaction.user.id)
-        user_name = interaction.user.display_name
+def archive_settled_history(conn):
+    """Moves each guild's drives/fills from before the month of its last /settle to the archive schema.
+    Returns the number of rows moved."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT archive_settled_history_func()")
+        archived = cur.fetchone()[0]
+        conn.commit()
+        return archived
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
 
-        conn = None
-        try:
-            conn = get_db_connection()
-
-            # --- Calculate Cost ---
-            car_data = next((car for car in CARS if car["name"] == selected_car_name), None)
-            if not car_data:
-                await interaction.followup.send("❌ Error: Invalid car data selected.", ephemeral=True)
-                return # No need to close conn here, finally block handles it
-
-            mpg = car_data["mpg"]
-            current_gas_price = get_current_gas_price(conn)
-            cost = calculate_cost(self.distance, mpg, current_gas_price)
-
-            # --- Record Drive ---
-            car_id = get_car_id_from_name(conn, selected_car_name)
-            record_drive(
-                conn=conn, user_id=user_id, user_name=user_name, car_id=car_id,
-                distance=self.distance, cost=cost, near_empty=False,
-                timestamp_iso=datetime.datetime.now().isoformat(),
-                location=self.location_name
-            )
+def get_recent_history(conn, guild_id, user_id=None, limit=10):
+    """Returns (drives, fills) rows, newest first, from live and archived history.
 
-            # --- Get Fresh Data & Format Message ---
-            users_with_miles = get_all_users_with_miles(conn)
-            nickname_mapping = {
-                "858864178962235393": "Abbas", "513552727096164378": "Sajjad",
-                "758778170421018674": "Jafar", "838206242127085629": "Mosa",
-                "393241098002235392": "Ali",
+    drives: (timestamp, user_id, user_name, car_id, distance, cost)
+    fills: (timestamp, user_id, user_name, car_id, payment_amount, payer_id)
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT timestamp, user_id, user_name, car_id, distance, cost
+            FROM drives_history
+            WHERE guild_id = %s AND (%s::BIGINT IS NULL OR user_id = %s)
+            ORDER BY timestamp DESC LIMIT %s
+            """,
+            (guild_id, user_id, user_id, limit)
+        )
+        drives = cur.fetchall()
+        cur.execute(
+            """
+            SELECT timestamp, user_id, user_name, car_id, payment_amount, payer_id
+            FROM fills_history
+            WHERE guild_id = %s AND (%s::BIGINT IS NULL OR user_id = %s OR payer_id = %s)
+            ORDER BY timestamp DESC LIMIT %s
+            """,
+            (guild_id, user_id, user_id, user_id, limit)
+        )
+        return drives, cur.fetchall()
+    finally:
+        cur.close()
+
+EXPORT_QUERIES = {
+    "drives": """
+        SELECT d.id, d.timestamp, d.user_id, d.user_name, c.name AS car, d.distance, d.cost
+        FROM drives_history d LEFT JOIN cars c ON c.id = d.car_id
+        WHERE d.guild_id = %s ORDER BY d.timestamp
+    """,
+    "fills": """
+        SELECT f.id, f.timestamp, f.user_id, f.user_name, c.name AS car, f.payment_amount, f.payer_id
+        FROM fills_history f LEFT JOIN cars c ON c.id = f.car_id
+        WHERE f.guild_id = %s ORDER BY f.timestamp
+    """,
+}
+
+def export_history_csv(conn, guild_id):
+    """Returns {"drives": bytes, "fills": bytes} CSV exports (with header) of the guild's full history."""
+    cur = conn.cursor()
+    exports = {}
+    try:
+        for name, query in EXPORT_QUERIES.items():
+            buffer = io.StringIO()
+            copy_sql = cur.mogrify(f"COPY ({query}) TO STDOUT WITH CSV HEADER", (guild_id,)).decode()
+            cur.copy_expert(copy_sql, buffer)
+            exports[name] = buffer.getvalue().encode()
+        return exports
+    finally:
+        cur.close()
+
+# --- Car Fuel State (one car_state row per car, kept current by record_drive_func/record_fill_func) ---
+def get_car_states(conn, guild_id):
+    """Returns one dict per car in the guild with its MPG, cost per mile and fuel estimate."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT * FROM get_car_data_func(%s)", (guild_id,))
+        return [
+            {
+                "id": car_id, "name": name, "mpg": mpg, "tank_gallons": float(tank_gallons),
+                "cost_per_mile": float(cost_per_mile) if cost_per_mile is not None else 0.0,
+                "miles_since_fill": float(miles_since_fill), "gallons_left": float(gallons_left),
+                "near_empty": near_empty, "last_fill_at": last_fill_at,
             }
-            nickname = nickname_mapping.get(user_id, user_name)
+            for car_id, name, mpg, tank_gallons, cost_per_mile, miles_since_fill, gallons_left, near_empty, last_fill_at
+            in cur.fetchall()
+        ]
+    finally:
+        cur.close()
 
-            # --- CONSTRUCT THE OUTPUT MESSAGE ---
-            if self.location_name:
-                 primary_message = f"**{nickname}** drove to **{self.location_name}** in a **{selected_car_name}**: **${cost:.2f}**"
-            else:
-                 # Format distance nicely (remove .0 if whole number)
-                 distance_str = f"{self.distance:.1f}".rstrip('0').rstrip('.') if '.' in f"{self.distance:.1f}" else str(int(self.distance))
-                 primary_message = f"**{nickname}** drove **{distance_str} miles** in a **{selected_car_name}**: **${cost:.2f}**"
-
-            balance_message = format_balance_message(users_with_miles, interaction)
-            full_message = primary_message + "\n\n" + balance_message
-
-            # --- Purge and Send to Target Channel ---
-            target_channel = interaction.guild.get_channel(TARGET_CHANNEL_ID) if interaction.guild else None
-            confirmation_message = "✅ Drive recorded."
-            if target_channel:
-                try:
-                    await target_channel.purge(limit=None)
-                    await target_channel.send(full_message)
-                    confirmation_message = "✅ Drive recorded and message sent to channel!"
-                except discord.errors.Forbidden:
-                     logger.error(f"Bot lacks permissions to purge/send in channel {TARGET_CHANNEL_ID}")
-                     confirmation_message = "✅ Drive recorded, but failed to update channel (permissions missing)."
-                except Exception as e:
-                     logger.error(f"Error purging/sending message to {TARGET_CHANNEL_ID}: {e}")
-                     confirmation_message = "✅ Drive recorded, but failed to update channel (error)."
-            else:
-                logger.warning(f"Target channel {TARGET_CHANNEL_ID} not found.")
-                confirmation_message = "✅ Drive recorded, but target channel not found."
-
-            await interaction.followup.send(confirmation_message, ephemeral=True)
-
-        except ValueError as e:
-             logger.error(f"Value error during drive recording: {e}", exc_info=True)
-             await interaction.followup.send(f"❌ Error: {e}", ephemeral=True)
-        except psycopg2.Error as db_err:
-            logger.error(f"Database error during drive recording: {db_err}", exc_info=True)
-            await interaction.followup.send("❌ A database error occurred.", ephemeral=True)
-            if conn: conn.rollback()
-        except Exception as e:
-            logger.error(f"Unexpected error in CarDropdown callback: {e}", exc_info=True)
-            await interaction.followup.send("❌ An unexpected error occurred.", ephemeral=True)
-            if conn: conn.rollback()
-        finally:
-            if conn and not conn.closed:
-                conn.close()
+# --- Bot UI Elements ---
 
-class DroveView(discord.ui.View):
-    """View for initiating a drive record."""
-    def __init__(self, distance: float, location_name: str = None, timeout=180):
-        super().__init__(timeout=timeout)
-        self.add_item(CarDropdown(distance=distance, location_name=location_name))
+# Car prompts are stateless DynamicItems: everything needed to finish the
+# drive/fill (owner, distance or payment, location or payer) is encoded in the
+# custom_id, so pending prompts hold no memory and survive restarts/redeploys.
+CAR_SELECT_TEMPLATE = r"gas:(?P<action>drive|fill):(?P<owner_id>[0-9]+):(?P<value>[0-9]+):(?P<extra>[a-z0-9]*)"
+
+class CarSelect(discord.ui.DynamicItem[discord.ui.Select], template=CAR_SELECT_TEMPLATE):
+    """Persistent car dropdown shared by drive and fill prompts.
+
+    `value` is the distance in tenths of a mile for drives and the payment in
+    cents for fills. `extra` is the location command key for drives and the
+    payer's user ID for fills (empty if not given). Option values are car IDs
+    (prompts sent before cars were per guild used car names; those still resolve).
+    """
+    def __init__(self, action: str, owner_id: int, value: int, extra: str = "", cars=None):
+        self.action = action
+        self.owner_id = owner_id
+        self.value = value
+        self.extra = extra
+        cars = cars or [] # Options only matter when sending; selections arrive as car IDs
+        if action == "drive":
+            placeholder = "Choose the car..."
+            options = [
+                discord.SelectOption(label=car["name"], value=str(car["id"]), description=f"{car['mpg']} MPG")
+                for car in cars
+            ]
+        else:
+            placeholder = "Choose a car..."
+            options = [discord.SelectOption(label=car["name"], value=str(car["id"])) for car in cars]
+        super().__init__(
+            discord.ui.Select(
+                custom_id=f"gas:{action}:{owner_id}:{value}:{extra}",
+                placeholder=placeholder, options=options, min_values=1, max_values=1,
+            )
+        )
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(
+            action=match["action"], owner_id=int(match["owner_id"]),
+            value=int(match["value"]), extra=match["extra"],
+        )
 
-    # Keep interaction check
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        original_user_id = None
-        if hasattr(interaction.message, 'interaction') and interaction.message.interaction:
-            original_user_id = interaction.message.interaction.user.id
-        if not original_user_id:
-             logger.warning("Could not reliably determine original interaction user for drive check.")
-             await interaction.response.send_message("Could not verify original command user.", ephemeral=True)
-             return False
-        if interaction.user.id != original_user_id:
+        if not await reject_if_unavailable(interaction):
+            return False
+        if interaction.user.id != self.owner_id:
             await interaction.response.send_message("This is not your command!", ephemeral=True)
             return False
         return True
 
-# --- Fill related UI (CarDropdownFill, FillView) - Keep As Is ---
-class CarDropdownFill(discord.ui.Select):
-    def __init__(self, cars):
-        options = [discord.SelectOption(label=car["name"]) for car in cars]
-        super().__init__(placeholder="Choose a car...", options=options)
-
     async def callback(self, interaction: discord.Interaction):
-        # Keep existing fill logic from previous version
-        self.view.selected_car = self.values[0]
-        await interaction.response.defer(ephemeral=True, thinking=True)
+        selected_car_id = resolve_selected_car_id(get_cached_guild_config(interaction.guild_id), self.item.values[0])
+        if selected_car_id is None:
+            await interaction.response.edit_message(content="❌ That car is no longer set up in this server.", view=None)
+            return
+        if self.action == "drive":
+            await handle_drive_car_selected(interaction, selected_car_id, self.value / 10.0, self.extra or None)
+        else:
+            payer_id = self.extra or None
+            await handle_fill_car_selected(interaction, selected_car_id, self.value / 100.0, payer_id)
+
+def resolve_selected_car_id(guild_config, value):
+    """Maps a selected option value to a car ID: current prompts send the ID, older ones the car name."""
+    if value.isdigit():
+        return int(value)
+    car = next((car for car in guild_config["cars"] if car["name"] == value), None)
+    return car["id"] if car else None
+
+def build_car_prompt_view(action: str, owner_id: int, value: int, extra: str = "", cars=None) -> discord.ui.View:
+    """Wraps a CarSelect in a view; fully dynamic views are not kept in the view store."""
+    view = discord.ui.View(timeout=None)
+    view.add_item(CarSelect(action=action, owner_id=owner_id, value=value, extra=extra, cars=cars))
+    return view
+
+@tracks_write
+async def handle_drive_car_selected(interaction: discord.Interaction, car_id: int, distance: float, location_key: str = None):
+    """Records a drive once the car has been picked from the prompt."""
+    # Acknowledge by replacing the prompt, so its select can't be used again
+    await interaction.response.edit_message(content="⏳ Recording your drive...", view=None)
+
+    guild_id = interaction.guild_id
+    user_id = str(interaction.user.id)
+    user_name = interaction.user.display_name
 
+    conn = None
+    try:
+        conn = get_db_connection()
+        guild_config = get_guild_config(conn, guild_id)
+
+        # --- Calculate Cost ---
+        car_data = find_car(guild_config, car_id)
+        if not car_data:
+            await interaction.followup.send("❌ Error: Invalid car data selected.", ephemeral=True)
+            return # No need to close conn here, finally block handles it
+        selected_car_name = car_data["name"]
+
+        location_data = guild_config["locations"].get(location_key) if location_key else None
+        location_name = location_data["location"] if location_data else None
+
+        mpg = car_data["mpg"]
+        current_gas_price = get_current_gas_price(conn, guild_id)
+        cost = calculate_cost(distance, mpg, current_gas_price)
+
+        # --- Record Drive ---
+        fuel_state = record_drive(
+            conn=conn, guild_id=guild_id, user_id=user_id, user_name=user_name, car_id=car_id,
+            distance=distance, cost=cost,
+            timestamp_iso=datetime.datetime.now().isoformat(),
+            location=location_name
+        )
+
+        # --- Get Fresh Data & Format Message ---
+        users_with_miles = get_all_users_with_miles(conn, guild_id)
+        # Hand the connection back before the channel purge/send (Discord I/O can take seconds)
+        release_db_connection(conn)
         conn = None
-        try:
-            conn = get_db_connection()
-            user_id = str(interaction.user.id)
-            user_name = interaction.user.display_name
-            car_name = self.view.selected_car
-            payment_amount = self.view.payment
-            payer_id = self.view.payer # Should be string ID or None
-
-            logger.debug(f"Fill callback - User ID: {user_id}, User Name: {user_name}, Car Name: {car_name}, Payment: {payment_amount}, Payer ID: {payer_id}")
-
-            record_fill(
-                conn=conn, user_id=user_id, user_name=user_name, car_name=car_name,
-                gallons=0, price_per_gallon=0, # Dummy values
-                payment_amount=payment_amount,
-                timestamp_iso=datetime.datetime.now().isoformat(),
-                payer_id=payer_id
+        nickname = display_name_for(guild_config, user_id, user_name)
+
+        # --- CONSTRUCT THE OUTPUT MESSAGE ---
+        if location_name:
+             primary_message = f"**{nickname}** drove to **{location_name}** in a **{selected_car_name}**: **${cost:.2f}**"
+        else:
+             # Format distance nicely (remove .0 if whole number)
+             distance_str = f"{distance:.1f}".rstrip('0').rstrip('.') if '.' in f"{distance:.1f}" else str(int(distance))
+             primary_message = f"**{nickname}** drove **{distance_str} miles** in a **{selected_car_name}**: **${cost:.2f}**"
+
+        # Low-fuel nudge: only on the drive that crossed the guild's threshold
+        if fuel_state["became_near_empty"] and guild_config["low_fuel_nudge"]:
+            primary_message += (
+                f"\n⛽ The **{selected_car_name}** is running low (about {fuel_state['gallons_left']:.1f} gal left)."
+                " Please fill it up and log it with `/filled`."
             )
 
-            # --- Get Fresh Data & Format Message ---
-            users_with_miles = get_all_users_with_miles(conn)
-            nickname_mapping = {
-                "858864178962235393": "Abbas", "513552727096164378": "Sajjad",
-                "758778170421018674": "Jafar", "838206242127085629": "Mosa",
-                "393241098002235392": "Ali",
-            }
-            nickname = nickname_mapping.get(user_id, user_name)
-
-            message = f"**{nickname}** filled the **{car_name}** and paid **${payment_amount:.2f}**.\n\n"
-            message += format_balance_message(users_with_miles, interaction)
-
-            # --- Purge and Send ---
-            target_channel = interaction.guild.get_channel(TARGET_CHANNEL_ID) if interaction.guild else None
-            confirmation_message = "✅ Fill recorded."
-            if target_channel:
-                 try:
-                      await target_channel.purge(limit=None)
-                      await target_channel.send(message)
-                      confirmation_message = "✅ Fill recorded and message sent to channel!"
-                 except discord.errors.Forbidden:
-                      logger.error(f"Bot lacks permissions to purge/send in channel {TARGET_CHANNEL_ID} for fill.")
-                      confirmation_message = "✅ Fill recorded, but failed to update channel (permissions missing)."
-                 except Exception as e:
-                      logger.error(f"Error purging/sending fill message to {TARGET_CHANNEL_ID}: {e}")
-                      confirmation_message = "✅ Fill recorded, but failed to update channel (error)."
-            else:
-                 logger.warning(f"Target channel {TARGET_CHANNEL_ID} not found for fill.")
-                 confirmation_message = "✅ Fill recorded, but target channel not found."
+        balance_message = format_balance_message(users_with_miles, guild_config)
+        full_message = primary_message + "\n\n" + balance_message
 
-            await interaction.followup.send(confirmation_message, ephemeral=True)
+        # --- Purge and Send to Target Channel ---
+        target_channel_id = guild_config["target_channel_id"]
+        target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild and target_channel_id else None
+        confirmation_message = "✅ Drive recorded."
+        if target_channel:
+            try:
+                await target_channel.purge(limit=None)
+                await target_channel.send(full_message)
+                confirmation_message = "✅ Drive recorded and message sent to channel!"
+            except discord.errors.Forbidden:
+                 logger.error(f"Bot lacks permissions to purge/send in channel {target_channel_id}")
+                 confirmation_message = "✅ Drive recorded, but failed to update channel (permissions missing)."
+            except Exception as e:
+                 logger.error(f"Error purging/sending message to {target_channel_id}: {e}")
+                 confirmation_message = "✅ Drive recorded, but failed to update channel (error)."
+        else:
+            logger.warning(f"Target channel {target_channel_id} not found in guild {guild_id}.")
+            confirmation_message = "✅ Drive recorded, but target channel not found (set it with `/config channel`)."
 
-        except psycopg2.Error as db_err:
-             logger.error(f"Database error during fill recording: {db_err}", exc_info=True)
-             await interaction.followup.send("❌ A database error occurred during fill.", ephemeral=True)
-             if conn: conn.rollback()
-        except Exception as e:
-            logger.error(f"Error in fill callback: {e}", exc_info=True)
-            await interaction.followup.send("❌ Failed to record fill.", ephemeral=True)
-            if conn: conn.rollback()
-        finally:
-            if conn and not conn.closed:
-                conn.close()
+        await interaction.followup.send(confirmation_message, ephemeral=True)
+
+    except ValueError as e:
+         logger.error(f"Value error during drive recording: {e}", exc_info=True)
+         await interaction.followup.send(f"❌ Error: {e}", ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error during drive recording: {db_err}", exc_info=True)
+        await interaction.followup.send("❌ A database error occurred.", ephemeral=True)
+        if conn: conn.rollback()
+    except Exception as e:
+        logger.error(f"Unexpected error in drive car selection: {e}", exc_info=True)
+        await interaction.followup.send("❌ An unexpected error occurred.", ephemeral=True)
+        if conn: conn.rollback()
+    finally:
+        release_db_connection(conn)
 
-class FillView(discord.ui.View):
-    # Keep As Is
-    def __init__(self, payment, payer, timeout=180):
-        super().__init__(timeout=timeout)
-        self.payment = payment
-        self.payer = payer
-        self.selected_car = None
-        self.add_item(CarDropdownFill(CARS))
+@tracks_write
+async def handle_fill_car_selected(interaction: discord.Interaction, car_id: int, payment_amount: float, payer_id: str = None):
+    """Records a fill once the car has been picked from the prompt."""
+    # Acknowledge by replacing the prompt, so its select can't be used again
+    await interaction.response.edit_message(content="⏳ Recording your fill...", view=None)
 
-    # Keep interaction check As Is
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-         original_user_id = None
-         if hasattr(interaction.message, 'interaction') and interaction.message.interaction:
-             original_user_id = interaction.message.interaction.user.id
-         if not original_user_id:
-              logger.warning("Could not reliably determine original interaction user for fill check.")
-              await interaction.response.send_message("Could not verify original command user.", ephemeral=True)
-              return False
-         if interaction.user.id != original_user_id:
-             await interaction.response.send_message("This is not your command!", ephemeral=True)
-             return False
-         return True
+    guild_id = interaction.guild_id
+    conn = None
+    try:
+        conn = get_db_connection()
+        guild_config = get_guild_config(conn, guild_id)
+        user_id = str(interaction.user.id)
+        user_name = interaction.user.display_name
+
+        car_data = find_car(guild_config, car_id)
+        if not car_data:
+            await interaction.followup.send("❌ Error: Invalid car data selected.", ephemeral=True)
+            return
+        car_name = car_data["name"]
+
+        logger.debug(f"Fill callback - Guild: {guild_id}, User ID: {user_id}, User Name: {user_name}, Car: {car_name} ({car_id}), Payment: {payment_amount}, Payer ID: {payer_id}")
+
+        record_fill(
+            conn=conn, guild_id=guild_id, user_id=user_id, user_name=user_name, car_id=car_id,
+            gallons=0, price_per_gallon=0, # Dummy values
+            payment_amount=payment_amount,
+            timestamp_iso=datetime.datetime.now().isoformat(),
+            payer_id=payer_id,
+            allocation=guild_config["fill_allocation"]
+        )
+
+        # --- Get Fresh Data & Format Message ---
+        users_with_miles = get_all_users_with_miles(conn, guild_id)
+        # Hand the connection back before the channel purge/send (Discord I/O can take seconds)
+        release_db_connection(conn)
+        conn = None
+        nickname = display_name_for(guild_config, user_id, user_name)
+
+        message = f"**{nickname}** filled the **{car_name}** and paid **${payment_amount:.2f}**"
+        message += f" ({FILL_ALLOCATION_MODES[guild_config['fill_allocation']]}).\n\n"
+        message += format_balance_message(users_with_miles, guild_config)
+
+        # --- Purge and Send ---
+        target_channel_id = guild_config["target_channel_id"]
+        target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild and target_channel_id else None
+        confirmation_message = "✅ Fill recorded."
+        if target_channel:
+             try:
+                  await target_channel.purge(limit=None)
+                  await target_channel.send(message)
+                  confirmation_message = "✅ Fill recorded and message sent to channel!"
+             except discord.errors.Forbidden:
+                  logger.error(f"Bot lacks permissions to purge/send in channel {target_channel_id} for fill.")
+                  confirmation_message = "✅ Fill recorded, but failed to update channel (permissions missing)."
+             except Exception as e:
+                  logger.error(f"Error purging/sending fill message to {target_channel_id}: {e}")
+                  confirmation_message = "✅ Fill recorded, but failed to update channel (error)."
+        else:
+             logger.warning(f"Target channel {target_channel_id} not found in guild {guild_id} for fill.")
+             confirmation_message = "✅ Fill recorded, but target channel not found (set it with `/config channel`)."
+
+        await interaction.followup.send(confirmation_message, ephemeral=True)
+
+    except psycopg2.Error as db_err:
+         logger.error(f"Database error during fill recording: {db_err}", exc_info=True)
+         await interaction.followup.send("❌ A database error occurred during fill.", ephemeral=True)
+         if conn: conn.rollback()
+    except Exception as e:
+        logger.error(f"Error in fill callback: {e}", exc_info=True)
+        await interaction.followup.send("❌ Failed to record fill.", ephemeral=True)
+        if conn: conn.rollback()
+    finally:
+        release_db_connection(conn)
 
 # --- NoteView, CarDropdownNote REMOVED ---
 
 # --- Bot Commands ---
 
 # --- Central Drive Interaction Starter ---
-async def start_drive_interaction(interaction: discord.Interaction, miles: float, location_name: str = None):
-    """Creates the DroveView and sends the initial ephemeral prompt."""
+async def start_drive_interaction(interaction: discord.Interaction, miles: float, location_key: str = None):
+    """Sends the ephemeral car prompt for a drive (location_key is a key of the guild's locations)."""
     if miles < 0: # Allow 0 miles now
         await interaction.response.send_message("Miles driven cannot be negative.", ephemeral=True)
         return
@@ -505,9 +1263,23 @@ async def start_drive_interaction(interaction: discord.Interaction, miles: float
          await interaction.response.send_message("That seems like an unreasonably long drive!", ephemeral=True)
          return
 
-    view = DroveView(distance=miles, location_name=location_name)
+    guild_config = get_cached_guild_config(interaction.guild_id)
+    if not guild_config["cars"]:
+        await interaction.response.send_message("No cars are set up for this server yet. Add one with `/config car`.", ephemeral=True)
+        return
+
+    view = build_car_prompt_view("drive", interaction.user.id, round(miles * 10), location_key or "", cars=guild_config["cars"])
     await interaction.response.send_message("Which car did you drive?", view=view, ephemeral=True)
 
+async def start_location_drive(interaction: discord.Interaction, location_key: str):
+    """Looks up a location in the guild's config and starts the drive prompt for it."""
+    guild_config = get_cached_guild_config(interaction.guild_id)
+    location_data = guild_config["locations"].get(location_key)
+    if not location_data:
+        await interaction.response.send_message(f"`{location_key}` is not a location in this server. See `/help` for the list.", ephemeral=True)
+        return
+    await start_drive_interaction(interaction, location_data["miles"], location_key)
+
 # --- /drove command REMOVED ---
 
 # --- MODIFIED Numbered Commands Factory (/0 to /100 with optional decimal) ---
@@ -517,6 +1289,7 @@ def create_number_command(miles_value: int):
     # Define the actual command coroutine function inside the factory
     @app_commands.command(name=str(miles_value), description=f"Log a drive of {miles_value} miles (+ optional .1 to .9).")
     @app_commands.describe(decimal="Add decimal miles (e.g., 5 for .5 miles)")
+    @app_commands.guild_only()
     async def dynamic_command(interaction: discord.Interaction,
                               # Optional argument for decimal part, restricted to 1-9
                               decimal: Optional[app_commands.Range[int, 1, 9]] = None):
@@ -538,16 +1311,20 @@ def create_number_command(miles_value: int):
 
     return dynamic_command # Return the coroutine function
 
-# --- Location Commands Factory (Keep As Is) ---
+# --- Location Commands Factory ---
 def create_location_command(command_name: str, data: dict):
-    """Factory function to create location-based drive commands."""
+    """Factory function to create location-based drive commands.
+
+    The command is global, but miles/location come from the invoking guild's config.
+    """
     miles_value = data["miles"]
     location_name = data["location"]
 
     @app_commands.command(name=command_name.lower(), description=f"Log drive to {location_name} ({miles_value} miles).")
+    @app_commands.guild_only()
     async def dynamic_command(interaction: discord.Interaction):
         try:
-            await start_drive_interaction(interaction, miles_value, location_name)
+            await start_location_drive(interaction, command_name.lower())
         except Exception as e:
              logger.error(f"Error in location command /{command_name}: {e}", exc_info=True)
              try:
@@ -557,70 +1334,138 @@ def create_location_command(command_name: str, data: dict):
 
     return dynamic_command
 
-# --- Event: on_ready ---
-@client.event
-async def on_ready():
-    print(f"Logged in as {client.user}")
-    conn = None
+# --- Background Tasks ---
+@tasks.loop(minutes=ROLLUP_REFRESH_MINUTES)
+async def refresh_rollups_task():
     try:
-        print("Connecting to database for initialization...")
-        conn = get_db_connection()
-        print("Initializing cars in database...")
-        initialize_cars_in_db(conn)
-        print("Car initialization complete.")
-    except Exception as e: # Catch broader exceptions during startup DB connection
-         print(f"!!! Database connection/initialization error on ready: {e}")
-         # Depending on severity, you might want to exit or try reconnecting later
-    finally:
-        if conn and not conn.closed:
-            conn.close()
-            print("Database connection closed after init.")
+        await client.wait_until_warm()
+        await client.run_db(refresh_daily_rollups)
+        logger.debug("Daily usage rollups refreshed.")
+    except Exception as e:
+        logger.error(f"Error refreshing daily usage rollups: {e}", exc_info=True)
 
-    print("Registering dynamic commands...")
+@tasks.loop(hours=HISTORY_MAINTENANCE_HOURS)
+async def history_maintenance_task():
+    try:
+        await client.wait_until_warm()
+        created = await client.run_db(ensure_monthly_partitions)
+        archived = await client.run_db(archive_settled_history)
+        logger.info(f"History maintenance: {created} partition(s) created, {archived} row(s) archived.")
+    except Exception as e:
+        logger.error(f"Error during history maintenance: {e}", exc_info=True)
+
+# --- Startup: Command Registration & Sync ---
+def register_drive_commands(tree):
+    """Adds the numbered (/0../59) and location shortcut commands to the tree (called from setup_hook)."""
     registered_commands = 0
     # Register numbered commands /0 to /100
     # Range goes up to, but does not include, the stop value
     for i in range(0, 60):
         try:
-            cmd_func = create_number_command(i)
-            client.tree.add_command(cmd_func)
+            tree.add_command(create_number_command(i))
             registered_commands += 1
         except Exception as e:
-            print(f"Error registering command /{i}: {e}")
-    print(f"  Attempted to register {registered_commands} numbered commands (0-100).")
+            logger.error(f"Error registering command /{i}: {e}")
 
     # Register location commands
     location_commands_registered = 0
     for name, data in LOCATION_COMMANDS.items():
         try:
-            cmd_func = create_location_command(name, data)
-            client.tree.add_command(cmd_func)
+            tree.add_command(create_location_command(name, data))
             location_commands_registered += 1
         except Exception as e:
-             print(f"Error registering location command /{name}: {e}")
-    print(f"  Attempted to register {location_commands_registered} location commands.")
-
-    # Sync commands
-    try:
-        # Consider syncing per guild during development for speed
-        # guild_id = YOUR_GUILD_ID # Replace with your test server ID
-        # synced = await client.tree.sync(guild=discord.Object(id=guild_id))
-        # print(f"Synced {len(synced)} command(s) to guild {guild_id}.")
-        # Sync globally for production
-        synced = await client.tree.sync()
-        print(f"Synced {len(synced)} command(s) globally.")
+             logger.error(f"Error registering location command /{name}: {e}")
+    logger.info(f"Registered {registered_commands} numbered and {location_commands_registered} location commands.")
+
+async def sync_commands_if_changed(bot):
+    """Syncs the global command tree only when its definition changed since the last sync.
+
+    A global sync is slow and rate limited, so the hash of the synced payload is kept in
+    bot_state and compared on each start (set FORCE_COMMAND_SYNC=1 to sync anyway).
+    """
+    try:
+        payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        await bot.wait_until_warm()
+        stored_digest = await bot.run_db(get_bot_state, "command_tree_hash")
+        if stored_digest == digest and not os.environ.get("FORCE_COMMAND_SYNC"):
+            logger.info(f"Command tree unchanged ({len(payload)} commands); skipping global sync.")
+            return
+        # Consider syncing per guild during development for speed:
+        # synced = await bot.tree.sync(guild=discord.Object(id=YOUR_GUILD_ID))
+        synced = await bot.tree.sync()
+        await bot.run_db(set_bot_state, "command_tree_hash", digest)
+        logger.info(f"Synced {len(synced)} command(s) globally.")
+    except Exception as e:
+        logger.error(f"Error syncing commands: {e}", exc_info=True)
+
+# --- Event: on_ready ---
+@client.event
+async def on_ready():
+    logger.info(
+        f"Logged in as {client.user} ({client.shard_count or 1} shard(s), {len(client.guilds)} guild(s)) "
+        f"{time.monotonic() - PROCESS_STARTED_AT:.2f}s after start."
+    )
+    try:
+        await client.wait_until_warm()
+        # Guilds joined while the bot was offline get their default config seeded now
+        missing = [guild.id for guild in client.guilds if guild.id not in GUILD_CONFIG_CACHE]
+        if missing:
+            await client.run_db(load_guild_configs, missing)
+        logger.info(f"Guild configuration cached for {len(GUILD_CONFIG_CACHE)} guild(s).")
+    except Exception as e: # Catch broader exceptions during startup DB connection
+         logger.error(f"Database connection/initialization error on ready: {e}", exc_info=True)
+
+@client.event
+async def on_interaction(interaction: discord.Interaction):
+    if not client.first_interaction_logged:
+        client.first_interaction_logged = True
+        logger.info(f"First interaction received {time.monotonic() - PROCESS_STARTED_AT:.2f}s after start.")
+
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    """Seeds and caches the default config as soon as the bot joins a new guild."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        get_guild_config(conn, guild.id)
+        logger.info(f"Joined guild {guild.name} ({guild.id}); config ready.")
     except Exception as e:
-        print(f"Error syncing commands: {e}")
+        logger.error(f"Error preparing config for new guild {guild.id}: {e}", exc_info=True)
+    finally:
+        release_db_connection(conn)
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    invalidate_guild_config(guild.id)
 
 # --- Existing Commands (filled, balance, allbalances, settle, help) ---
 # Keep the existing command functions for filled, balance, allbalances, settle
-# Make sure filled uses the updated CarDropdownFill and FillView if necessary
+# filled sends a stateless CarSelect prompt (see build_car_prompt_view)
+
+@client.tree.command(name="go")
+@app_commands.describe(place="One of this server's saved locations")
+@app_commands.guild_only()
+async def go(interaction: discord.Interaction, place: str):
+    """Logs a drive to any of this server's saved locations."""
+    await start_location_drive(interaction, place.lower())
+
+@go.autocomplete("place")
+async def go_place_autocomplete(interaction: discord.Interaction, current: str):
+    guild_config = get_cached_guild_config(interaction.guild_id)
+    current = current.lower()
+    return [
+        app_commands.Choice(name=f"{data['location']} ({data['miles']} mi)", value=key)
+        for key, data in sorted(guild_config["locations"].items())
+        if current in key or current in data["location"].lower()
+    ][:25]
 
 @client.tree.command(name="filled")
 @app_commands.describe(
     payment="Total payment amount (e.g., 45.50)",
     payer="Who paid? (Optional - select user)"
 )
+@app_commands.guild_only()
 async def filled(interaction: discord.Interaction, payment: float, payer: Optional[discord.Member] = None): # Use Optional
     """Records a gas fill-up and payment."""
     if payment <= 0:
@@ -631,25 +1476,30 @@ async def filled(interaction: discord.Interaction, payment: float, payer: Option
     payer_id_str = str(payer_member.id)
     payer_display_name = payer_member.display_name
 
-    logger.info(f"/filled: User={interaction.user.id}, Payment={payment}, Payer={payer_display_name}({payer_id_str})")
+    logger.info(f"/filled: Guild={interaction.guild_id}, User={interaction.user.id}, Payment={payment}, Payer={payer_display_name}({payer_id_str})")
+
+    guild_config = get_cached_guild_config(interaction.guild_id)
+    if not guild_config["cars"]:
+        await interaction.response.send_message("No cars are set up for this server yet. Add one with `/config car`.", ephemeral=True)
+        return
 
-    fill_view = FillView(payment=payment, payer=payer_id_str)
+    fill_view = build_car_prompt_view("fill", interaction.user.id, round(payment * 100), payer_id_str, cars=guild_config["cars"])
     await interaction.response.send_message(
         f"Select the car filled (Payment: ${payment:.2f} by {payer_display_name}):",
         view=fill_view,
         ephemeral=True
     )
 
-# --- record_fill (Keep As Is) ---
-def record_fill(conn, user_id, user_name, car_name, gallons, price_per_gallon,
-                payment_amount, timestamp_iso, payer_id=None):
-    # Keep this function as is from previous version
+# --- record_fill ---
+def record_fill(conn, guild_id, user_id, user_name, car_id, gallons, price_per_gallon,
+                payment_amount, timestamp_iso, payer_id=None, allocation="equal"):
+    """Records a fill; `allocation` is one of FILL_ALLOCATION_MODES."""
     cur = conn.cursor()
-    logger.debug(f"record_fill: user_id={user_id}, user_name={user_name}, car_name={car_name}, gallons={gallons}, price_per_gallon={price_per_gallon}, payment_amount={payment_amount}, payer_id={payer_id}, timestamp_iso={timestamp_iso}")
+    logger.debug(f"record_fill: guild_id={guild_id}, user_id={user_id}, user_name={user_name}, car_id={car_id}, gallons={gallons}, price_per_gallon={price_per_gallon}, payment_amount={payment_amount}, payer_id={payer_id}, timestamp_iso={timestamp_iso}, allocation={allocation}")
     try:
-        cur.execute("CALL record_fill_func(%s, %s, %s, %s, %s, %s, %s, %s)",
-                    (user_id, user_name, car_name, float(gallons), float(price_per_gallon),
-                     float(payment_amount), timestamp_iso, payer_id))
+        cur.execute("CALL record_fill_func(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    (guild_id, user_id, user_name, car_id, float(gallons), float(price_per_gallon),
+                     float(payment_amount), timestamp_iso, payer_id, allocation))
         conn.commit()
         logger.debug("record_fill_func executed successfully.")
     except Exception as e:
@@ -662,15 +1512,16 @@ def record_fill(conn, user_id, user_name, car_name, gallons, price_per_gallon,
 # --- /note command REMOVED ---
 
 @client.tree.command(name="balance")
+@app_commands.guild_only()
+@tracks_write
 async def balance(interaction: discord.Interaction):
     """Shows your personal current balance owed."""
-    # Keep this command as is from previous version
     conn = None
     try:
         conn = get_db_connection()
         user_id = str(interaction.user.id)
         user_name = interaction.user.display_name
-        user_data = get_or_create_user(conn, user_id, user_name)
+        user_data = get_or_create_user(conn, interaction.guild_id, user_id, user_name)
         balance_val = user_data.get('total_owed', 0.0)
         await interaction.response.send_message(f"Your current balance is: **${balance_val:.2f}**", ephemeral=True)
     except psycopg2.Error as db_err:
@@ -680,22 +1531,27 @@ async def balance(interaction: discord.Interaction):
         logger.error(f"Error in /balance command: {e}", exc_info=True)
         await interaction.response.send_message("❌ An error occurred retrieving your balance.", ephemeral=True)
     finally:
-        if conn and not conn.closed: conn.close()
+        release_db_connection(conn)
 
 @client.tree.command(name="allbalances")
+@app_commands.guild_only()
 async def allbalances(interaction: discord.Interaction):
     """Updates the main channel with the balances of all tracked users."""
-    # Keep this command as is from previous version
     await interaction.response.defer(thinking=True, ephemeral=True) # Defer ephemerally initially
     conn = None
-    target_channel_id = TARGET_CHANNEL_ID # Use constant
-    target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild else None
+    guild_id = interaction.guild_id
     sent_publicly = False
 
     try:
         conn = get_db_connection()
-        users_with_miles = get_all_users_with_miles(conn)
-        message = format_balance_message(users_with_miles, interaction)
+        guild_config = get_guild_config(conn, guild_id)
+        target_channel_id = guild_config["target_channel_id"]
+        target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild and target_channel_id else None
+        users_with_miles = get_all_users_with_miles(conn, guild_id)
+        # Hand the connection back before the channel purge/send (Discord I/O can take seconds)
+        release_db_connection(conn)
+        conn = None
+        message = format_balance_message(users_with_miles, guild_config)
 
         if target_channel:
             try:
@@ -710,8 +1566,8 @@ async def allbalances(interaction: discord.Interaction):
                 logger.error(f"Error purging/sending allbalances message to {target_channel_id}: {e}")
                 await interaction.followup.send(f"⚠️ Balances retrieved, but failed to update <#{target_channel_id}> (Error).\n{message}", ephemeral=True)
         else:
-            logger.warning(f"Target channel {target_channel_id} not found for allbalances.")
-            await interaction.followup.send(f"⚠️ Target channel <#{target_channel_id}> not found. Displaying balances here:\n{message}", ephemeral=True)
+            logger.warning(f"Target channel {target_channel_id} not found in guild {guild_id} for allbalances.")
+            await interaction.followup.send(f"⚠️ Target channel not found (set it with `/config channel`). Displaying balances here:\n{message}", ephemeral=True)
 
     except psycopg2.Error as db_err:
         logger.error(f"Database error in /allbalances command: {db_err}", exc_info=True)
@@ -720,33 +1576,36 @@ async def allbalances(interaction: discord.Interaction):
         logger.error(f"Error in /allbalances command: {e}", exc_info=True)
         await interaction.followup.send("❌ An error occurred displaying balances.", ephemeral=True)
     finally:
-        if conn and not conn.closed: conn.close()
+        release_db_connection(conn)
 
 
 # --- /car_usage command REMOVED ---
 
 
 @client.tree.command(name="settle")
+@app_commands.guild_only()
+@tracks_write
 async def settle(interaction: discord.Interaction):
     """Resets all user balances to zero."""
-    # Keep this command as is from previous version
     await interaction.response.defer(thinking=True, ephemeral=True)
     conn = None
-    target_channel_id = TARGET_CHANNEL_ID
-    target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild else None
+    guild_id = interaction.guild_id
 
     try:
         conn = get_db_connection()
-        users_with_miles = get_all_users_with_miles(conn)
-        logger.info(f"Settling balances for {len(users_with_miles)} users...")
-        for user_id, user_data in users_with_miles.items():
-            user_name = user_data["name"]
-            save_user_data(conn, user_id, user_name, 0)
-            logger.info(f"Reset balance for user {user_name} ({user_id})")
-
-        users_with_miles_reset = get_all_users_with_miles(conn) # Fetch again to show 0 balances
+        guild_config = get_guild_config(conn, guild_id)
+        target_channel_id = guild_config["target_channel_id"]
+        target_channel = interaction.guild.get_channel(target_channel_id) if interaction.guild and target_channel_id else None
+
+        settled_count = settle_guild_balances(conn, guild_id)
+        logger.info(f"Reset balances for {settled_count} users in guild {guild_id}.")
+
+        users_with_miles_reset = get_all_users_with_miles(conn, guild_id) # Fetch again to show 0 balances
+        # Hand the connection back before the channel purge/send (Discord I/O can take seconds)
+        release_db_connection(conn)
+        conn = None
         message = "**Balances have been settled to zero.**\n\n"
-        message += format_balance_message(users_with_miles_reset, interaction)
+        message += format_balance_message(users_with_miles_reset, guild_config)
 
         if target_channel:
              try:
@@ -760,8 +1619,8 @@ async def settle(interaction: discord.Interaction):
                  logger.error(f"Error purging/sending settle message to {target_channel_id}: {e}")
                  await interaction.followup.send(f"⚠️ Balances settled, but failed to update <#{target_channel_id}> (Error).\n{message}", ephemeral=True)
         else:
-             logger.warning(f"Target channel {target_channel_id} not found for settle.")
-             await interaction.followup.send(f"⚠️ Balances settled (Target channel <#{target_channel_id}> not found).\n{message}", ephemeral=True)
+             logger.warning(f"Target channel {target_channel_id} not found in guild {guild_id} for settle.")
+             await interaction.followup.send(f"⚠️ Balances settled (target channel not found, set it with `/config channel`).\n{message}", ephemeral=True)
 
     except psycopg2.Error as db_err:
         logger.error(f"Database error during /settle: {db_err}", exc_info=True)
@@ -772,31 +1631,372 @@ async def settle(interaction: discord.Interaction):
         await interaction.followup.send("❌ An error occurred while settling balances.", ephemeral=True)
         if conn: conn.rollback()
     finally:
-        if conn and not conn.closed: conn.close()
+        release_db_connection(conn)
+
+# --- /stats (reads only the daily rollups) ---
+STATS_PERIODS = {
+    "week": {"count": 8, "label": "week"},
+    "month": {"count": 6, "label": "month"},
+}
+
+def period_start(day, period):
+    """Maps a date to the first day of its week (Monday) or month."""
+    if period == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def stats_window_start(today, period):
+    """First day of the oldest bucket shown for the given period."""
+    start = period_start(today, period)
+    for _ in range(STATS_PERIODS[period]["count"] - 1):
+        start = period_start(start - datetime.timedelta(days=1), period)
+    return start
+
+def aggregate_rollups(rows):
+    """Sums rollup rows into per-user, per-car and per-period totals in a single pass."""
+    per_user = defaultdict(lambda: [0.0, 0.0, 0.0, 0.0]) # miles, cost, fill share, fill paid
+    per_car = defaultdict(lambda: [0.0, 0.0, 0]) # miles, cost, drives
+    per_bucket = defaultdict(float) # miles
+    for day, user_id, car_id, miles, drive_cost, drive_count, fill_share, fill_paid in rows:
+        miles, drive_cost = float(miles), float(drive_cost)
+        user_totals = per_user[str(user_id)]
+        user_totals[0] += miles
+        user_totals[1] += drive_cost
+        user_totals[2] += float(fill_share)
+        user_totals[3] += float(fill_paid)
+        car_totals = per_car[car_id]
+        car_totals[0] += miles
+        car_totals[1] += drive_cost
+        car_totals[2] += drive_count
+        per_bucket[day] += miles
+    return per_user, per_car, per_bucket
+
+def format_bar(value, max_value, width=16):
+    if max_value <= 0:
+        return ""
+    return "█" * max(1 if value > 0 else 0, round(width * value / max_value))
+
+def format_stats_message(rows, guild_config, user_names, period, today):
+    """Renders the /stats message: member and car tables plus a text trend chart."""
+    per_user, per_car, per_day = aggregate_rollups(rows)
+    label = STATS_PERIODS[period]["label"]
+
+    buckets = defaultdict(float)
+    for day, miles in per_day.items():
+        buckets[period_start(day, period)] += miles
+    bucket_starts = []
+    start = stats_window_start(today, period)
+    while start <= today:
+        bucket_starts.append(start)
+        start = period_start(start + datetime.timedelta(days=32 if period == "month" else 7), period)
+
+    message = f"**📊 Stats for the last {STATS_PERIODS[period]['count']} {label}s**\n"
+    message += "```\n--- Members ---\n"
+    message += f"{'Name':<12}{'Miles':>8}{'Cost':>9}{'Fills':>9}{'Paid':>9}\n"
+    if not per_user:
+        message += "No activity yet.\n"
+    for user_id, (miles, cost, fill_share, fill_paid) in sorted(per_user.items(), key=lambda item: -item[1][0]):
+        name = display_name_for(guild_config, user_id, user_names.get(user_id, f"User {user_id}"))[:11]
+        message += f"{name:<12}{miles:>8.1f}{cost:>9.2f}{fill_share:>9.2f}{fill_paid:>9.2f}\n"
+
+    message += "\n--- Cars ---\n"
+    message += f"{'Car':<18}{'Miles':>8}{'Cost':>9}{'Drives':>8}\n"
+    if not per_car:
+        message += "No drives yet.\n"
+    for car_id, (miles, cost, drives) in sorted(per_car.items(), key=lambda item: -item[1][0]):
+        car = find_car(guild_config, car_id)
+        name = (car["name"] if car else f"Car {car_id}")[:17]
+        message += f"{name:<18}{miles:>8.1f}{cost:>9.2f}{drives:>8}\n"
+
+    message += f"\n--- Miles per {label} ---\n"
+    max_miles = max((buckets[start] for start in bucket_starts), default=0.0)
+    for start in bucket_starts:
+        bucket_label = start.strftime("%b %d") if period == "week" else start.strftime("%b %Y")
+        message += f"{bucket_label:<9}{format_bar(buckets[start], max_miles):<17}{buckets[start]:.1f}\n"
+    message += "```"
+    message += f"\n*Fills = share of fill costs charged, Paid = fill payments made. Refreshed every {ROLLUP_REFRESH_MINUTES} min.*"
+    return message
+
+@client.tree.command(name="stats")
+@app_commands.describe(period="Group the trend by week (last 8) or month (last 6)")
+@app_commands.choices(period=[
+    app_commands.Choice(name="Weekly", value="week"),
+    app_commands.Choice(name="Monthly", value="month"),
+])
+@app_commands.guild_only()
+async def stats(interaction: discord.Interaction, period: Optional[app_commands.Choice[str]] = None):
+    """Shows miles, costs and fill shares per member and per car."""
+    period_value = period.value if period else "week"
+    conn = None
+    try:
+        conn = get_db_connection()
+        guild_config = get_guild_config(conn, interaction.guild_id)
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        rows = get_daily_rollups(conn, interaction.guild_id, stats_window_start(today, period_value))
+        user_names = get_user_names(conn, interaction.guild_id)
+        message = format_stats_message(rows, guild_config, user_names, period_value, today)
+        await interaction.response.send_message(message[:2000], ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error in /stats command: {db_err}", exc_info=True)
+        await interaction.response.send_message("❌ A database error occurred retrieving stats.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in /stats command: {e}", exc_info=True)
+        await interaction.response.send_message("❌ An error occurred retrieving stats.", ephemeral=True)
+    finally:
+        release_db_connection(conn)
+
+# --- /cars (reads the per-car fuel state, one row per car) ---
+def format_cars_message(car_states, guild_config):
+    """Renders the /cars message: fuel estimate and cost per mile for each car."""
+    message = "**🚗 Cars**\n```\n"
+    message += f"{'Car':<18}{'MPG':>5}{'$/mi':>7}{'Since fill':>12}{'Fuel left':>14}\n"
+    if not car_states:
+        message += "No cars configured.\n"
+    for car in car_states:
+        flag = " ⛽" if car["near_empty"] else ""
+        fuel_left = f"{car['gallons_left']:.1f}/{car['tank_gallons']:g} gal"
+        message += f"{car['name'][:17]:<18}{car['mpg']:>5}{car['cost_per_mile']:>7.3f}{car['miles_since_fill']:>9.1f} mi{fuel_left:>14}{flag}\n"
+    message += "```"
+    message += f"\n*Fuel left is estimated from miles driven and MPG since the last fill. ⛽ = at or below {guild_config['low_fuel_percent']}% of the tank.*"
+    return message
+
+@client.tree.command(name="cars")
+@app_commands.guild_only()
+async def cars(interaction: discord.Interaction):
+    """Shows each car's estimated fuel left and miles since its last fill."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        guild_config = get_guild_config(conn, interaction.guild_id)
+        message = format_cars_message(get_car_states(conn, interaction.guild_id), guild_config)
+        await interaction.response.send_message(message[:2000], ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error in /cars command: {db_err}", exc_info=True)
+        await interaction.response.send_message("❌ A database error occurred retrieving car data.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in /cars command: {e}", exc_info=True)
+        await interaction.response.send_message("❌ An error occurred retrieving car data.", ephemeral=True)
+    finally:
+        release_db_connection(conn)
+
+# --- /history and /export (read live + archived rows through the history views) ---
+def format_history_message(drives, fills, guild_config, title):
+    """Renders the /history message: recent drives and fills, newest first."""
+    message = f"**🧾 {title}**\n```\n--- Drives ---\n"
+    if not drives:
+        message += "No drives yet.\n"
+    for timestamp, user_id, user_name, car_id, distance, cost in drives:
+        car = find_car(guild_config, car_id)
+        name = display_name_for(guild_config, str(user_id), user_name)[:11]
+        car_name = (car["name"] if car else f"Car {car_id}")[:14]
+        message += f"{timestamp:%Y-%m-%d} {name:<12}{car_name:<15}{float(distance):>7.1f} mi ${float(cost):>7.2f}\n"
+
+    message += "\n--- Fills ---\n"
+    if not fills:
+        message += "No fills yet.\n"
+    for timestamp, user_id, user_name, car_id, payment_amount, payer_id in fills:
+        car = find_car(guild_config, car_id)
+        payer_key = str(payer_id) if payer_id is not None else str(user_id)
+        name = display_name_for(guild_config, payer_key, user_name)[:11]
+        car_name = (car["name"] if car else f"Car {car_id}")[:14]
+        message += f"{timestamp:%Y-%m-%d} {name:<12}{car_name:<15}${float(payment_amount):>7.2f}\n"
+    message += "```"
+    return message
+
+@client.tree.command(name="history")
+@app_commands.describe(member="Only show this member's drives and fills (Optional)")
+@app_commands.guild_only()
+async def history(interaction: discord.Interaction, member: Optional[discord.Member] = None):
+    """Shows the latest drives and fills, including archived months."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        guild_config = get_guild_config(conn, interaction.guild_id)
+        drives, fills = get_recent_history(conn, interaction.guild_id, member.id if member else None)
+        title = f"Recent history for {display_name_for(guild_config, str(member.id), member.display_name)}" if member else "Recent history"
+        message = format_history_message(drives, fills, guild_config, title)
+        await interaction.response.send_message(message[:2000], ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error in /history command: {db_err}", exc_info=True)
+        await interaction.response.send_message("❌ A database error occurred retrieving history.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in /history command: {e}", exc_info=True)
+        await interaction.response.send_message("❌ An error occurred retrieving history.", ephemeral=True)
+    finally:
+        release_db_connection(conn)
+
+@client.tree.command(name="export")
+@app_commands.guild_only()
+async def export(interaction: discord.Interaction):
+    """Sends every drive and fill recorded in this server as CSV files."""
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    try:
+        exports = await client.run_db(export_history_csv, interaction.guild_id)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+        files = [discord.File(io.BytesIO(data), filename=f"{name}_{stamp}.csv") for name, data in exports.items()]
+        await interaction.followup.send("📎 Full drive and fill history (including archived months):", files=files, ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error in /export command: {db_err}", exc_info=True)
+        await interaction.followup.send("❌ A database error occurred exporting history.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in /export command: {e}", exc_info=True)
+        await interaction.followup.send("❌ An error occurred exporting history.", ephemeral=True)
+
+# --- /dbprofile (bot owner only: the slow-query log covers every server) ---
+def format_dbprofile_message(rows, slowest):
+    """Renders the /dbprofile message: slow statements grouped by total time plus the slowest plan."""
+    message = f"**🐢 Slow DB statements (≥ {DB_SLOW_QUERY_MS:g} ms, last {DB_PROFILE_BUFFER} kept)**\n```\n"
+    message += f"{'Count':>5}{'Max ms':>9}{'Avg ms':>9}  Statement\n"
+    if not rows:
+        message += "None captured yet.\n"
+    for row in rows:
+        message += f"{row['count']:>5}{row['max_ms']:>9.0f}{row['avg_ms']:>9.0f}  {row['statement'][:120]}\n"
+    message += "```"
+    if slowest:
+        message += f"\nSlowest ({slowest['duration_ms']:.0f} ms at {slowest['at']:%H:%M:%S} UTC):\n```\n{slowest['plan'][:900]}\n```"
+    return message
+
+@client.tree.command(name="dbprofile")
+@app_commands.describe(clear="Empty the slow-query log after showing it")
+@app_commands.default_permissions(administrator=True)
+async def dbprofile(interaction: discord.Interaction, clear: bool = False):
+    """(Bot owner) Summarizes the slowest database statements seen since startup."""
+    if not await client.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot owner can view database profiling.", ephemeral=True)
+        return
+    if DB_SLOW_QUERY_MS is None:
+        await interaction.response.send_message("DB profiling is off. Set `DB_SLOW_QUERY_MS` (e.g. `200`) and restart the bot.", ephemeral=True)
+        return
+    rows, slowest = get_slow_query_summary()
+    if clear:
+        with slow_queries_lock:
+            SLOW_QUERIES.clear()
+    await interaction.response.send_message(format_dbprofile_message(rows, slowest)[:2000], ephemeral=True)
+
+# --- Per-Guild Configuration Commands (server managers only) ---
+config_group = app_commands.Group(
+    name="config", description="Configure the gas bot for this server.",
+    guild_only=True, default_permissions=discord.Permissions(manage_guild=True)
+)
+
+@tracks_write
+async def run_config_update(interaction: discord.Interaction, update, success_message: str):
+    """Runs a config write with a fresh connection and reports the outcome ephemerally."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        get_guild_config(conn, interaction.guild_id) # Make sure the guild row exists
+        result = update(conn)
+        if result is False:
+            await interaction.response.send_message("Nothing to change.", ephemeral=True)
+            return
+        await interaction.response.send_message(success_message, ephemeral=True)
+    except psycopg2.Error as db_err:
+        logger.error(f"Database error in /config for guild {interaction.guild_id}: {db_err}", exc_info=True)
+        await interaction.response.send_message("❌ A database error occurred saving the configuration.", ephemeral=True)
+        if conn: conn.rollback()
+    finally:
+        release_db_connection(conn)
+
+@config_group.command(name="channel", description="Set the channel where balances are posted.")
+async def config_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    await run_config_update(
+        interaction, lambda conn: set_guild_target_channel(conn, interaction.guild_id, channel.id),
+        f"✅ Balances will be posted in {channel.mention}."
+    )
+
+@config_group.command(name="nickname", description="Set (or clear) the name shown for a member in balances.")
+@app_commands.describe(nickname="Leave empty to clear the nickname")
+async def config_nickname(interaction: discord.Interaction, member: discord.Member, nickname: Optional[str] = None):
+    await run_config_update(
+        interaction, lambda conn: set_guild_nickname(conn, interaction.guild_id, member.id, nickname),
+        f"✅ {member.display_name} will be shown as **{nickname}**." if nickname else f"✅ Cleared nickname for {member.display_name}."
+    )
+
+@config_group.command(name="allocation", description="Choose how fill costs are split between members.")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="Equally between everyone", value="equal"),
+    app_commands.Choice(name="By miles driven in the car since its last fill", value="usage"),
+])
+async def config_allocation(interaction: discord.Interaction, mode: app_commands.Choice[str]):
+    await run_config_update(
+        interaction, lambda conn: set_guild_fill_allocation(conn, interaction.guild_id, mode.value),
+        f"✅ Fill costs will be {FILL_ALLOCATION_MODES[mode.value]}."
+    )
+
+@config_group.command(name="car", description="Add a car or update its MPG and tank size.")
+@app_commands.describe(tank="Tank size in gallons (Optional - used for the fuel estimate in /cars)")
+async def config_car(interaction: discord.Interaction, name: app_commands.Range[str, 1, 100], mpg: app_commands.Range[int, 1, 200],
+                     tank: Optional[app_commands.Range[float, 1, 100]] = None):
+    await run_config_update(
+        interaction, lambda conn: upsert_guild_car(conn, interaction.guild_id, name, mpg, tank),
+        f"✅ Car **{name}** saved ({mpg} MPG" + (f", {tank:g} gal tank)." if tank else ").")
+    )
+
+@config_group.command(name="lowfuel", description="Set when a car counts as near empty and whether to post a reminder.")
+@app_commands.describe(
+    percent="Near empty at or below this % of the tank (default 15)",
+    nudge="Post a fill-up reminder in the balances channel when a car becomes near empty"
+)
+async def config_lowfuel(interaction: discord.Interaction, percent: app_commands.Range[int, 0, 100], nudge: bool):
+    await run_config_update(
+        interaction, lambda conn: set_guild_low_fuel(conn, interaction.guild_id, percent, nudge),
+        f"✅ Cars are near empty at {percent}% of the tank; reminders are {'on' if nudge else 'off'}."
+    )
+
+@config_group.command(name="location", description="Add or update a location shortcut (use it with /go).")
+@app_commands.describe(key="Short lowercase name, letters and digits only (e.g. gym)", miles="Distance in miles, at most one decimal place")
+async def config_location(interaction: discord.Interaction, key: str, location: str, miles: app_commands.Range[float, 0, 10000]):
+    key = key.lower()
+    if not LOCATION_KEY_PATTERN.match(key):
+        await interaction.response.send_message("Location keys must be 1-32 lowercase letters or digits.", ephemeral=True)
+        return
+    if round(miles, 1) != miles: # Drive prompts carry the distance in tenths of a mile
+        await interaction.response.send_message("Miles can have at most one decimal place (e.g. 2.2).", ephemeral=True)
+        return
+    await run_config_update(
+        interaction, lambda conn: upsert_guild_location(conn, interaction.guild_id, key, location, miles),
+        f"✅ Location `{key}` saved: {location} ({miles} miles)."
+    )
+
+@config_group.command(name="removelocation", description="Remove a location shortcut from this server.")
+async def config_removelocation(interaction: discord.Interaction, key: str):
+    await run_config_update(
+        interaction, lambda conn: delete_guild_location(conn, interaction.guild_id, key.lower()),
+        f"✅ Location `{key.lower()}` removed."
+    )
+
+client.tree.add_command(config_group)
 
 # --- MODIFIED Help Command ---
 @client.tree.command(name="help")
+@app_commands.guild_only()
 async def help(interaction: discord.Interaction):
     """Provides instructions on how to use the Gas Bot."""
+    guild_config = get_cached_guild_config(interaction.guild_id)
+    target_channel_id = guild_config["target_channel_id"]
+    target_channel_mention = f"<#{target_channel_id}>" if target_channel_id else "the balances channel (not set yet - see `/config channel`)"
+    car_names = " or ".join(car["name"] for car in guild_config["cars"]) or "none configured"
+
     help_message = f"""
 **Gas Bot User Manual**
 
-Tracks gas expenses, driving, and calculates balances. Most results posted in <#{TARGET_CHANNEL_ID}>.
+Tracks gas expenses, driving, and calculates balances. Most results posted in {target_channel_mention}.
 
 **Mileage Commands (`/0` to `/100`):**
 *   Use `/0`, `/1`, `/2` ... `/100` to log drives of that mileage.
 *   **Optional Decimal:** Add a decimal from .1 to .9 using the `decimal` option.
     *   Example: `/15` `decimal: 5` logs a drive of **15.5 miles**.
     *   Example: `/8` logs a drive of **8.0 miles**.
-*   You will be prompted to select the car (Subaru or Mercedes).
+*   You will be prompted to select the car ({car_names}).
 
 **Location Shortcut Commands:**
-*   Use these commands to log drives to common locations:
+*   Use `/go` **place** (or the matching `/<place>` shortcut, if there is one) to log drives to this server's locations:
 """
     # Dynamically add location commands to help message
     loc_help = []
-    for cmd_name, data in sorted(LOCATION_COMMANDS.items()):
-        loc_help.append(f"    *   `/{cmd_name}` - Drive to {data['location']} ({data['miles']} miles)")
+    for cmd_name, data in sorted(guild_config["locations"].items()):
+        loc_help.append(f"    *   `{cmd_name}` - Drive to {data['location']} ({data['miles']} miles)")
     help_message += "\n".join(loc_help)
 
     help_message += f"""
@@ -807,13 +2007,18 @@ Tracks gas expenses, driving, and calculates balances. Most results posted in <#
     *   `payment`: Amount paid (e.g., `42.75`).
     *   `payer`: (Optional) User who paid (defaults to you).
 *   `/balance`: Shows *your* current balance (ephemeral - only you see this).
-*   `/allbalances`: Updates the main channel (<#{TARGET_CHANNEL_ID}>) with everyone's current balance.
+*   `/stats` [period]: Miles, costs and fill shares per member and car, with a weekly or monthly trend (ephemeral).
+*   `/cars`: Each car's estimated fuel left and miles since its last fill (ephemeral).
+*   `/history` [member]: Latest drives and fills, including archived months (ephemeral).
+*   `/export`: Full drive and fill history as CSV files (ephemeral).
+*   `/allbalances`: Updates the main channel ({target_channel_mention}) with everyone's current balance.
 *   `/settle`: Resets **all user balances to zero**. Use with caution!
+*   `/config`: (Server managers) Set the balances channel, fill cost split, low-fuel reminders, nicknames, cars and locations.
 *   `/help`: Displays this help message (ephemeral).
 
 **Removed Commands:** `/drove`, `/note`, `/car_usage`
 """
-    await interaction.response.send_message(help_message, ephemeral=True)
+    await interaction.response.send_message(help_message[:2000], ephemeral=True)
 
 # --- Function to start the bot (Keep As Is) ---
 async def main():